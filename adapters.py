@@ -4,10 +4,18 @@ import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
 
+try:
+  from gi.repository import GObject
+except ImportError:
+  import gobject as GObject
+
+import observers
+
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
 LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
 DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_IFACE = 'org.freedesktop.DBus'
 DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
 
 LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
@@ -18,17 +26,346 @@ GATT_SERVICE_IFACE = 'org.bluez.GattService1'
 GATT_CHRC_IFACE =    'org.bluez.GattCharacteristic1'
 GATT_DESC_IFACE =    'org.bluez.GattDescriptor1'
 
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+
+
+class AdapterRegistry(object):
+    """
+    Index of the BlueZ adapters, built from a single GetManagedObjects scan
+    and kept current through the ObjectManager InterfacesAdded and
+    InterfacesRemoved signals. Adapters can be looked up by name (e.g.
+    'hci0'), by address or by one of the interfaces they expose.
+
+    The registry also follows Device1.Connected so that the devices connected
+    through each adapter are known without another scan.
+
+    If bluetoothd is not running yet, the registry starts empty and scans
+    once org.bluez appears on the bus; when bluetoothd exits, its adapters
+    and connections are dropped.
+
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        self.adapters = {}
+        self.by_name = {}
+        self.by_address = {}
+        self.by_interface = {}
+        self.waiters = []
+        self.connected = {}
+        self.connection_listeners = []
+
+        bus.add_signal_receiver(self._interfaces_added,
+                                dbus_interface=DBUS_OM_IFACE,
+                                signal_name='InterfacesAdded',
+                                bus_name=BLUEZ_SERVICE_NAME)
+        bus.add_signal_receiver(self._interfaces_removed,
+                                dbus_interface=DBUS_OM_IFACE,
+                                signal_name='InterfacesRemoved',
+                                bus_name=BLUEZ_SERVICE_NAME)
+        bus.add_signal_receiver(self._device_properties_changed,
+                                dbus_interface=DBUS_PROP_IFACE,
+                                signal_name='PropertiesChanged',
+                                arg0=DEVICE_IFACE,
+                                bus_name=BLUEZ_SERVICE_NAME,
+                                path_keyword='path')
+        bus.add_signal_receiver(self._name_owner_changed,
+                                dbus_interface=DBUS_IFACE,
+                                signal_name='NameOwnerChanged',
+                                arg0=BLUEZ_SERVICE_NAME)
+        self.scan()
+
+    def scan(self):
+        """
+        Add the adapters and connected devices of bluetoothd. Returns False
+        if bluetoothd is not on the bus.
+
+        """
+        try:
+            remote_om = dbus.Interface(
+                    self.bus.get_object(BLUEZ_SERVICE_NAME, '/'),
+                    DBUS_OM_IFACE)
+            objects = remote_om.GetManagedObjects()
+        except dbus.exceptions.DBusException as e:
+            print('bluetoothd not available (%s), waiting for it' %
+                  e.get_dbus_name())
+            return False
+
+        for path, interfaces in objects.items():
+            if ADAPTER_IFACE in interfaces:
+                self._add(path, interfaces)
+            elif DEVICE_IFACE in interfaces:
+                if interfaces[DEVICE_IFACE].get('Connected', False):
+                    self._set_connected(str(path), True)
+        return True
+
+    def _name_owner_changed(self, name, old_owner, new_owner):
+        if old_owner:
+            print('bluetoothd left the bus')
+            for path in set(self.adapters) | set(self.connected):
+                self._remove(path)
+        if new_owner:
+            print('bluetoothd appeared on the bus')
+            if self.scan():
+                self._wake_waiters()
+
+    def _add(self, path, interfaces):
+        path = str(path)
+        entry = self.adapters.setdefault(path, {})
+        for interface, props in interfaces.items():
+            entry[str(interface)] = props
+            self.by_interface.setdefault(str(interface), set()).add(path)
+
+        self.by_name[path.rsplit('/', 1)[-1]] = path
+        adapter_props = entry.get(ADAPTER_IFACE)
+        if adapter_props and 'Address' in adapter_props:
+            self.by_address[str(adapter_props['Address']).upper()] = path
+
+    def _remove(self, path):
+        entry = self.adapters.pop(path, {})
+        for interface in entry:
+            self.by_interface.get(interface, set()).discard(path)
+
+        self.by_name.pop(path.rsplit('/', 1)[-1], None)
+        adapter_props = entry.get(ADAPTER_IFACE)
+        if adapter_props and 'Address' in adapter_props:
+            self.by_address.pop(str(adapter_props['Address']).upper(), None)
+
+        for device in sorted(self.connected.get(path, ())):
+            self._set_connected(device, False)
+        self.connected.pop(path, None)
+
+    def _set_connected(self, device, connected):
+        adapter = device.rsplit('/', 1)[0]
+        devices = self.connected.setdefault(adapter, set())
+        if connected == (device in devices):
+            return
+
+        if connected:
+            devices.add(device)
+        else:
+            devices.discard(device)
+
+        for listener in list(self.connection_listeners):
+            listener(device, adapter, connected)
+
+    def _device_properties_changed(self, interface, changed, invalidated,
+                                   path=None):
+        if path is None or 'Connected' not in changed:
+            return
+
+        self._set_connected(str(path), bool(changed['Connected']))
+
+    def add_connection_listener(self, listener):
+        """
+        Call listener(device, adapter, connected) whenever a device connects
+        to or disconnects from one of the adapters.
+
+        """
+        self.connection_listeners.append(listener)
+
+    def remove_connection_listener(self, listener):
+        if listener in self.connection_listeners:
+            self.connection_listeners.remove(listener)
+
+    def connected_devices(self, adapter):
+        return set(self.connected.get(adapter, ()))
+
+    def _interfaces_added(self, path, interfaces):
+        path = str(path)
+        if DEVICE_IFACE in interfaces:
+            if interfaces[DEVICE_IFACE].get('Connected', False):
+                self._set_connected(path, True)
+            return
+
+        if path not in self.adapters and ADAPTER_IFACE not in interfaces:
+            return
+
+        print('adapter interfaces added %s: %s' % (path, list(interfaces.keys())))
+        self._add(path, interfaces)
+        self._wake_waiters()
+
+    def _interfaces_removed(self, path, interfaces):
+        path = str(path)
+        if DEVICE_IFACE in interfaces:
+            self._set_connected(path, False)
+            return
+
+        if path not in self.adapters:
+            return
+
+        print('adapter interfaces removed %s: %s' % (path, list(interfaces)))
+        if ADAPTER_IFACE in interfaces:
+            self._remove(path)
+            return
+
+        entry = self.adapters[path]
+        for interface in interfaces:
+            entry.pop(str(interface), None)
+            self.by_interface.get(str(interface), set()).discard(path)
+
+    def find(self, adapter_interface_name, adapter_name=''):
+        """
+        Return the object path of the adapter called adapter_name (either its
+        name or its address) that exposes adapter_interface_name. An empty
+        adapter_name matches the first adapter exposing the interface.
+
+        """
+        candidates = self.by_interface.get(adapter_interface_name, ())
+        if not adapter_name:
+            for path in sorted(candidates):
+                return path
+            return None
+
+        path = self.by_name.get(adapter_name)
+        if path is None:
+            path = self.by_address.get(adapter_name.upper())
+        if path is not None and path in candidates:
+            return path
+
+        return None
+
+    def find_all(self, adapter_interface_name):
+        return sorted(self.by_interface.get(adapter_interface_name, ()))
+
+    def address(self, path):
+        props = self.adapters.get(path, {}).get(ADAPTER_IFACE, {})
+        return props.get('Address')
+
+    def wait_for_adapter(self, adapter_interface_name, adapter_name, callback,
+                         timeout=None):
+        """
+        Call callback(path) once a matching adapter is available. If timeout
+        (in seconds) elapses first, callback(None) is called instead.
+
+        """
+        path = self.find(adapter_interface_name, adapter_name)
+        if path is not None:
+            callback(path)
+            return
+
+        print('waiting for adapter %r with %s' %
+              (adapter_name, adapter_interface_name))
+        waiter = [adapter_interface_name, adapter_name, callback, None]
+        if timeout is not None:
+            waiter[3] = GObject.timeout_add(int(timeout * 1000),
+                                            self._waiter_timeout, waiter)
+        self.waiters.append(waiter)
+
+    def _waiter_timeout(self, waiter):
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+            waiter[2](None)
+        return False
+
+    def _wake_waiters(self):
+        for waiter in list(self.waiters):
+            path = self.find(waiter[0], waiter[1])
+            if path is None:
+                continue
+
+            self.waiters.remove(waiter)
+            if waiter[3] is not None:
+                GObject.source_remove(waiter[3])
+            waiter[2](path)
+
+
+_registries = {}
+
+
+class AdapterStats(object):
+    """
+    Per-adapter connection and traffic counters for an Application served on
+    several adapters. Connections come from the AdapterRegistry, traffic is
+    attributed to an adapter through the 'device' option BlueZ passes to
+    ReadValue and WriteValue.
+
+    """
+    def __init__(self, registry, adapter_paths):
+        self.registry = registry
+        self.adapter_paths = list(adapter_paths)
+        self.counters = {}
+        for adapter in self.adapter_paths:
+            self.counters[adapter] = {
+                'connections': 0,
+                'reads': 0,
+                'writes': 0,
+            }
+        registry.add_connection_listener(self._connection_changed)
+
+    def _connection_changed(self, device, adapter, connected):
+        counters = self.counters.get(adapter)
+        if counters is not None and connected:
+            counters['connections'] += 1
+
+    def record(self, device, name):
+        if device is None:
+            return
+
+        counters = self.counters.get(device.rsplit('/', 1)[0])
+        if counters is None:
+            return
+
+        if name == 'ReadValue':
+            counters['reads'] += 1
+        elif name == 'WriteValue':
+            counters['writes'] += 1
+
+    def __call__(self, obj, name, args, elapsed, error):
+        self.record(observers.options_device(args), name)
+
+    def report(self):
+        result = {}
+        for adapter in self.adapter_paths:
+            entry = dict(self.counters[adapter])
+            entry['connected'] = len(self.registry.connected_devices(adapter))
+            result[adapter] = entry
+        return result
+
+    def print_report(self):
+        for adapter, entry in sorted(self.report().items()):
+            print('%s: connected %d (total %d), reads %d, writes %d' %
+                  (adapter, entry['connected'], entry['connections'],
+                   entry['reads'], entry['writes']))
+        return True
+
+
+def get_registry(bus):
+    registry = _registries.get(bus)
+    if registry is None:
+        registry = AdapterRegistry(bus)
+        _registries[bus] = registry
+    return registry
+
 
 def find_adapter(bus, adapter_interface_name, adapter_name):
-    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'), DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
-
-    for o, props in objects.items():
-        print('checking adapter %s, keys: %s' % (o, props.keys()))
-        if adapter_interface_name in props.keys():
-            print('found adapter %s' % (o,))
-            if '/' + adapter_name in o:
-                print('returning adapter %s' % (o,))
-                return o
-
-    return None
+    adapter = get_registry(bus).find(adapter_interface_name, adapter_name)
+    if adapter is not None:
+        print('returning adapter %s' % (adapter,))
+    return adapter
+
+
+def find_adapters(bus, adapter_interface_name, adapter_names):
+    """
+    Return the object paths of the named adapters exposing
+    adapter_interface_name, or of all such adapters if adapter_names is empty.
+
+    """
+    registry = get_registry(bus)
+    if not adapter_names:
+        return registry.find_all(adapter_interface_name)
+
+    result = []
+    for adapter_name in adapter_names:
+        adapter = registry.find(adapter_interface_name, adapter_name)
+        if adapter is None:
+            raise Exception('%s interface not found on %s' %
+                            (adapter_interface_name, adapter_name))
+        result.append(adapter)
+    return result
+
+
+def wait_for_adapter(bus, adapter_interface_name, adapter_name, callback,
+                     timeout=None):
+    get_registry(bus).wait_for_adapter(adapter_interface_name, adapter_name,
+                                       callback, timeout)
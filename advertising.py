@@ -109,12 +109,7 @@ def register_ad_error_cb(mainloop, error):
     mainloop.quit()
 
 
-def advertising_main(mainloop, bus, adapter_name):
-    adapter = adapters.find_adapter(bus, LE_ADVERTISING_MANAGER_IFACE, adapter_name)
-    print('adapter: %s' % (adapter,))
-    if not adapter:
-        raise Exception('LEAdvertisingManager1 interface not found')
-
+def register_ad(mainloop, bus, adapter, advertisement=None):
     adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
                                    "org.freedesktop.DBus.Properties")
 
@@ -123,9 +118,50 @@ def advertising_main(mainloop, bus, adapter_name):
     ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
                                 LE_ADVERTISING_MANAGER_IFACE)
 
-    test_advertisement = TestAdvertisement(bus, 0)
+    if advertisement is None:
+        advertisement = TestAdvertisement(bus, 0)
 
-    ad_manager.RegisterAdvertisement(test_advertisement.get_path(), {},
+    ad_manager.RegisterAdvertisement(advertisement.get_path(), {},
                                      reply_handler=register_ad_cb,
                                      error_handler=functools.partial(register_ad_error_cb, mainloop))
 
+    return advertisement
+
+
+def adapter_ready_cb(mainloop, bus, adapter):
+    print('adapter: %s' % (adapter,))
+    if not adapter:
+        print('LEAdvertisingManager1 interface not found')
+        mainloop.quit()
+        return
+
+    register_ad(mainloop, bus, adapter)
+
+
+def advertising_main(mainloop, bus, adapter_name, wait_timeout=None):
+    if wait_timeout is not None:
+        adapters.wait_for_adapter(bus, LE_ADVERTISING_MANAGER_IFACE, adapter_name,
+                                  functools.partial(adapter_ready_cb, mainloop, bus),
+                                  wait_timeout)
+        return
+
+    adapter = adapters.find_adapter(bus, LE_ADVERTISING_MANAGER_IFACE, adapter_name)
+    print('adapter: %s' % (adapter,))
+    if not adapter:
+        raise Exception('LEAdvertisingManager1 interface not found')
+
+    return register_ad(mainloop, bus, adapter)
+
+
+def advertising_multi_main(mainloop, bus, adapter_names):
+    adapter_paths = adapters.find_adapters(bus, LE_ADVERTISING_MANAGER_IFACE,
+                                           adapter_names)
+    if not adapter_paths:
+        raise Exception('LEAdvertisingManager1 interface not found')
+
+    advertisement = TestAdvertisement(bus, 0)
+    for adapter in adapter_paths:
+        print('adapter: %s' % (adapter,))
+        register_ad(mainloop, bus, adapter, advertisement)
+
+    return advertisement
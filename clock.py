@@ -0,0 +1,158 @@
+"""
+Clock and timer scheduling for the producers and simulations.
+
+Code that runs on timers asks the scheduler returned by get_scheduler() for
+the time, timers and random numbers instead of using time, GObject and
+random directly. RealScheduler runs on the GLib main loop. VirtualScheduler
+runs timers in virtual time as fast as they can be called, with a seeded
+random generator, so that simulated hours take milliseconds and runs are
+reproducible.
+"""
+from __future__ import print_function
+import heapq
+import random
+import time
+
+try:
+  from gi.repository import GObject
+except ImportError:
+  import gobject as GObject
+
+
+class RealScheduler(object):
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    def now(self):
+        return time.monotonic()
+
+    def timeout_add(self, interval, callback, *args):
+        return GObject.timeout_add(interval, callback, *args)
+
+    def source_remove(self, source_id):
+        GObject.source_remove(source_id)
+
+
+class VirtualScheduler(object):
+    """
+    Timers in virtual time. Nothing runs until run() or advance() is called;
+    they call the due timers in order of their deadline, moving now() to each
+    deadline. Like GLib timeouts, a timer is rescheduled while its callback
+    returns True.
+
+    """
+    def __init__(self, seed=0, start=0.0):
+        self.time = start
+        self.random = random.Random(seed)
+        self.timers = []
+        self.sources = {}
+        self.next_id = 1
+        self.calls = 0
+
+    def now(self):
+        return self.time
+
+    def timeout_add(self, interval, callback, *args):
+        source_id = self.next_id
+        self.next_id += 1
+        self.sources[source_id] = (interval, callback, args)
+        heapq.heappush(self.timers,
+                       (self.time + interval / 1000.0, source_id))
+        return source_id
+
+    def source_remove(self, source_id):
+        # Removed timers are skipped when they come up
+        self.sources.pop(source_id, None)
+
+    def run(self, until=None):
+        """
+        Call the timers due up to virtual time until (all of them if None),
+        then move the clock to until. Returns the number of calls made.
+
+        """
+        calls = self.calls
+        while self.timers:
+            due, source_id = self.timers[0]
+            if until is not None and due > until:
+                break
+            heapq.heappop(self.timers)
+            source = self.sources.get(source_id)
+            if source is None:
+                continue
+
+            interval, callback, args = source
+            self.time = due
+            self.calls += 1
+            if callback(*args) and source_id in self.sources:
+                heapq.heappush(self.timers, (due + interval / 1000.0,
+                                             source_id))
+            else:
+                self.sources.pop(source_id, None)
+
+        if until is not None and until > self.time:
+            self.time = until
+        return self.calls - calls
+
+    def advance(self, seconds):
+        return self.run(self.time + seconds)
+
+
+_scheduler = RealScheduler()
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def set_scheduler(scheduler):
+    """
+    Make scheduler the one used by objects created from now on.
+
+    """
+    global _scheduler
+    _scheduler = scheduler
+
+
+def simulate(seconds=3600, seed=0):
+    """
+    Run the example services for seconds of virtual time against a LocalBus,
+    with one central connected and subscribed to the battery level and the
+    heart rate measurement.
+
+    """
+    import local_bus
+    import gatt_server
+    import adapters
+
+    scheduler = VirtualScheduler(seed)
+    set_scheduler(scheduler)
+    try:
+        bus = local_bus.LocalBus()
+        notifications = []
+        bus.add_signal_listener(
+                lambda path, iface, member, args: notifications.append(path))
+        app = gatt_server.Application(bus)
+        bus.emit_remote_signal('/org/bluez/hci0/dev_00_00_00_00_00_01',
+                               gatt_server.DBUS_PROP_IFACE,
+                               'PropertiesChanged', adapters.DEVICE_IFACE,
+                               {'Connected': True}, [])
+
+        heart_rate, battery = app.services[0], app.services[1]
+        battery.characteristics[0].StartNotify()
+        heart_rate.characteristics[0].StartNotify()
+
+        start = time.monotonic()
+        calls = scheduler.advance(seconds)
+        elapsed = time.monotonic() - start
+    finally:
+        set_scheduler(RealScheduler())
+
+    print('%d s simulated in %.3f s: %d timer calls, %d notifications, '
+          'battery %d%%, energy expended %d kJ' %
+          (seconds, elapsed, calls, len(notifications),
+           battery.characteristics[0].battery_lvl, heart_rate.energy_expended))
+    return elapsed
+
+
+if __name__ == '__main__':
+    simulate()
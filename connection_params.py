@@ -0,0 +1,161 @@
+"""
+Preferred LE connection parameters.
+
+The Peripheral Preferred Connection Parameters characteristic tells the
+central which connection interval, slave latency and supervision timeout the
+peripheral would like. A ConnectionPolicy chooses them from named PROFILES:
+services declare the profile they need in connection_profile, and the most
+demanding one (the shortest maximum interval) wins unless a profile or
+explicit parameters are set for the whole application.
+"""
+from __future__ import print_function
+import struct
+
+
+PPCP = struct.Struct('<HHHH')
+
+# Units of the characteristic value, in milliseconds
+INTERVAL_UNIT = 1.25
+TIMEOUT_UNIT = 10.0
+
+
+class ConnectionParameters(object):
+    """
+    Connection intervals and supervision timeout in milliseconds, slave
+    latency in connection events.
+
+    """
+    def __init__(self, min_interval, max_interval, latency, timeout):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.latency = latency
+        self.timeout = timeout
+        self.validate()
+
+    def validate(self):
+        if not 7.5 <= self.min_interval <= self.max_interval <= 4000:
+            raise ValueError('connection interval must be 7.5 ms to 4 s, '
+                             'min <= max')
+        if not 0 <= self.latency <= 499:
+            raise ValueError('slave latency must be 0 to 499')
+        if not 100 <= self.timeout <= 32000:
+            raise ValueError('supervision timeout must be 100 ms to 32 s')
+        if self.timeout <= (1 + self.latency) * self.max_interval * 2:
+            raise ValueError('supervision timeout must exceed '
+                             '(1 + latency) * max interval * 2')
+
+    def encode(self):
+        return PPCP.pack(int(round(self.min_interval / INTERVAL_UNIT)),
+                         int(round(self.max_interval / INTERVAL_UNIT)),
+                         self.latency,
+                         int(round(self.timeout / TIMEOUT_UNIT)))
+
+    @classmethod
+    def decode(cls, data):
+        min_interval, max_interval, latency, timeout = PPCP.unpack(bytes(data))
+        return cls(min_interval * INTERVAL_UNIT, max_interval * INTERVAL_UNIT,
+                   latency, timeout * TIMEOUT_UNIT)
+
+    def __eq__(self, other):
+        return isinstance(other, ConnectionParameters) and \
+                self.encode() == other.encode()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return ('ConnectionParameters(%g, %g, %d, %g)' %
+                (self.min_interval, self.max_interval, self.latency,
+                 self.timeout))
+
+
+PROFILES = {
+    # Reports go out on the next connection event and the LED output reports
+    # are not held back by slave latency
+    'low-latency': ConnectionParameters(11.25, 15, 0, 2000),
+    # Short intervals with many packets per event for bulk transfers
+    'throughput': ConnectionParameters(15, 30, 0, 4000),
+    # Periodic sensor values; the radio may skip up to 4 idle events
+    'low-power': ConnectionParameters(100, 200, 4, 6000),
+}
+
+
+def encode(parameters):
+    """
+    Value of the characteristic for parameters, all zero if None.
+
+    """
+    if parameters is None:
+        return bytes(PPCP.size)
+    return parameters.encode()
+
+
+class ConnectionPolicy(object):
+    def __init__(self):
+        self.profile = None
+        self.explicit = None
+        self.service_profiles = []
+        self.listeners = []
+
+    def add_service(self, service):
+        profile = getattr(service, 'connection_profile', None)
+        if profile is None:
+            return
+        if profile not in PROFILES:
+            raise ValueError('unknown connection profile: %s' % profile)
+        self.service_profiles.append(profile)
+        self._changed()
+
+    def remove_service(self, service):
+        profile = getattr(service, 'connection_profile', None)
+        if profile in self.service_profiles:
+            self.service_profiles.remove(profile)
+            self._changed()
+
+    def set_profile(self, profile):
+        """
+        Use profile for the whole application instead of the profiles of the
+        services; None goes back to the services.
+
+        """
+        if profile is not None and profile not in PROFILES:
+            raise ValueError('unknown connection profile: %s' % profile)
+        self.profile = profile
+        self._changed()
+
+    def set_parameters(self, parameters):
+        self.explicit = parameters
+        self._changed()
+
+    def parameters(self):
+        if self.explicit is not None:
+            return self.explicit
+        if self.profile is not None:
+            return PROFILES[self.profile]
+        if not self.service_profiles:
+            return None
+        return min((PROFILES[profile] for profile in self.service_profiles),
+                   key=lambda parameters: parameters.max_interval)
+
+    def add_listener(self, listener):
+        """
+        Call listener(parameters) whenever the preferred parameters change.
+
+        """
+        self.listeners.append(listener)
+
+    def _changed(self):
+        parameters = self.parameters()
+        for listener in list(self.listeners):
+            listener(parameters)
+
+
+_policy = None
+
+
+def get_policy():
+    global _policy
+    if _policy is None:
+        _policy = ConnectionPolicy()
+    return _policy
+
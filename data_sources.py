@@ -0,0 +1,235 @@
+from __future__ import print_function
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+try:
+  from gi.repository import GObject
+except ImportError:
+  import gobject as GObject
+
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+MAX_READ = 4096
+
+
+def parse_int(raw):
+    return int(raw.strip())
+
+
+def parse_text(raw):
+    return raw.strip().decode('utf-8', 'replace')
+
+
+class Inotify(object):
+    """
+    One inotify instance watching the directories of the watched files, so
+    that files replaced by rename are still followed. Events are dispatched
+    by (directory, file name) from a main loop io watch.
+
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.dirs = {}
+        self.callbacks = {}
+        GObject.io_add_watch(self.fd, GObject.IO_IN, self._events)
+
+    def watch(self, path, callback):
+        directory, name = os.path.split(os.path.abspath(path))
+        wd = self.dirs.get(directory)
+        if wd is None:
+            wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed',
+                              directory)
+            self.dirs[directory] = wd
+        self.callbacks.setdefault((wd, os.fsencode(name)), []).append(callback)
+
+    def _events(self, fd, condition):
+        try:
+            data = os.read(self.fd, MAX_READ)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return True
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            for callback in self.callbacks.get((wd, name), ()):
+                callback()
+        return True
+
+
+_inotify = None
+
+
+def get_inotify():
+    global _inotify
+    if _inotify is None:
+        _inotify = Inotify()
+    return _inotify
+
+
+class DataSource(object):
+    """
+    Value read from a file or sysfs attribute. Callbacks are called with the
+    parsed value whenever it really changes.
+
+    How changes are picked up depends on the file:
+    - sysfs attributes the driver updates with sysfs_notify() (notify=True)
+      are watched for POLLPRI on their open file descriptor;
+    - regular files are watched with inotify;
+    - everything else (most sysfs attributes, e.g. power_supply capacity) is
+      polled, backing off from min_interval to max_interval milliseconds
+      while the value stays the same.
+
+    The raw contents are compared before parsing, so unchanged reads cost no
+    parse.
+
+    """
+    def __init__(self, path, parse=parse_int, notify=False,
+                 min_interval=1000, max_interval=60000):
+        self.path = path
+        self.parse = parse
+        self.notify = notify
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.callbacks = []
+        self.raw = None
+        self.value = None
+        self.fd = None
+        self.timer = None
+        self.mode = None
+        self.reads = 0
+        self.parses = 0
+        self.changes = 0
+        self.check()
+
+    def add_callback(self, callback):
+        """
+        Call callback(value) whenever the parsed value changes.
+
+        """
+        self.callbacks.append(callback)
+
+    def _read(self):
+        self.reads += 1
+        if self.fd is not None:
+            return os.pread(self.fd, MAX_READ, 0)
+        with open(self.path, 'rb') as f:
+            return f.read(MAX_READ)
+
+    def check(self):
+        """
+        Read the file and notify the callbacks if the value changed. Returns
+        True if it did.
+
+        """
+        try:
+            raw = self._read()
+        except (IOError, OSError) as e:
+            print('Data source %s: %s' % (self.path, e))
+            return False
+
+        if raw == self.raw:
+            return False
+        self.raw = raw
+
+        self.parses += 1
+        try:
+            value = self.parse(raw)
+        except ValueError as e:
+            print('Data source %s: %s' % (self.path, e))
+            return False
+
+        if value == self.value:
+            return False
+        self.value = value
+        self.changes += 1
+        for callback in list(self.callbacks):
+            callback(value)
+        return True
+
+    def start(self):
+        if self.mode is not None:
+            return self.mode
+
+        if self.notify:
+            self.fd = os.open(self.path, os.O_RDONLY)
+            GObject.io_add_watch(self.fd, GObject.IO_PRI | GObject.IO_ERR,
+                                 self._pri_cb)
+            self.mode = 'pri'
+        elif not self.path.startswith('/sys/'):
+            try:
+                get_inotify().watch(self.path, self.check)
+                self.mode = 'inotify'
+            except (AttributeError, OSError) as e:
+                print('Data source %s: no inotify (%s), polling' %
+                      (self.path, e))
+
+        if self.mode is None:
+            self.mode = 'poll'
+            self._schedule(self.min_interval)
+        return self.mode
+
+    def _pri_cb(self, fd, condition):
+        # sysfs_notify() wakes pollers with POLLPRI | POLLERR; the attribute
+        # has to be read from offset 0 to rearm.
+        self.check()
+        return True
+
+    def _schedule(self, interval):
+        self.interval = interval
+        self.timer = GObject.timeout_add(interval, self._poll)
+
+    def _poll(self):
+        if self.check():
+            interval = self.min_interval
+        else:
+            interval = min(self.interval * 2, self.max_interval)
+
+        if interval == self.interval:
+            return True
+        self._schedule(interval)
+        return False
+
+
+_sources = {}
+
+
+def bind(key, path, **kwargs):
+    """
+    Create and start the data source the characteristics of this process
+    read key from.
+
+    """
+    source = DataSource(path, **kwargs)
+    source.start()
+    _sources[key] = source
+    return source
+
+
+def get_source(key):
+    return _sources.get(key)
@@ -8,15 +8,17 @@ import array
 
 import functools
 
-try:
-  from gi.repository import GObject
-except ImportError:
-  import gobject as GObject
-
-from random import randint
-
 import exceptions
 import adapters
+import clock
+import data_sources
+import indications
+import notify_filter
+import observers
+import read_cache
+import sessions
+import value_signal
+import value_table
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
 LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
@@ -40,6 +42,7 @@ class Application(dbus.service.Object):
     def __init__(self, bus):
         self.path = '/'
         self.services = []
+        self.registered = False
         dbus.service.Object.__init__(self, bus, self.path)
         self.add_service(HeartRateService(bus, 0))
         self.add_service(BatteryService(bus, 1))
@@ -49,7 +52,55 @@ class Application(dbus.service.Object):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
+        """
+        Add service. Once the application is registered, only the objects of
+        the new service are announced to BlueZ, with InterfacesAdded.
+
+        """
         self.services.append(service)
+        self.publish(service)
+
+    def remove_service(self, service):
+        """
+        Remove service at runtime, with InterfacesRemoved for its objects.
+
+        """
+        self.services.remove(service)
+        self.unpublish(service)
+        for obj in service.get_objects():
+            obj.remove_from_connection()
+
+    def add_characteristic(self, service, chrc):
+        """
+        Add chrc to a published service. BlueZ allocates the handles of a
+        service in one block, so the service is removed and added again.
+
+        """
+        self.unpublish(service)
+        service.add_characteristic(chrc)
+        self.publish(service)
+
+    def remove_characteristic(self, service, chrc):
+        self.unpublish(service)
+        service.remove_characteristic(chrc)
+        chrc.remove_from_connection()
+        for desc in chrc.get_descriptors():
+            desc.remove_from_connection()
+        self.publish(service)
+
+    def publish(self, service):
+        # bluetoothd indicates Service Changed from its own GATT service
+        # when the services of an application are added or removed
+        if not self.registered:
+            return
+        for path, interfaces in service.get_managed_objects():
+            self.InterfacesAdded(path, interfaces)
+
+    def unpublish(self, service):
+        if not self.registered:
+            return
+        for path, interfaces in reversed(service.get_managed_objects()):
+            self.InterfacesRemoved(path, list(interfaces.keys()))
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
@@ -57,16 +108,18 @@ class Application(dbus.service.Object):
         print('GetManagedObjects')
 
         for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
+            response.update(service.get_managed_objects())
 
         return response
 
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
 
 class Service(dbus.service.Object):
     """
@@ -80,6 +133,7 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.handle = 0
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -87,6 +141,7 @@ class Service(dbus.service.Object):
                 GATT_SERVICE_IFACE: {
                         'UUID': self.uuid,
                         'Primary': self.primary,
+                        'Handle': dbus.UInt16(self.handle),
                         'Characteristics': dbus.Array(
                                 self.get_characteristic_paths(),
                                 signature='o')
@@ -99,6 +154,25 @@ class Service(dbus.service.Object):
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
 
+    def remove_characteristic(self, characteristic):
+        self.characteristics.remove(characteristic)
+
+    def get_objects(self):
+        """
+        The service, its characteristics and their descriptors, parents
+        first.
+
+        """
+        result = [self]
+        for chrc in self.characteristics:
+            result.append(chrc)
+            result.extend(chrc.get_descriptors())
+        return result
+
+    def get_managed_objects(self):
+        return [(obj.get_path(), obj.get_properties())
+                for obj in self.get_objects()]
+
     def get_characteristic_paths(self):
         result = []
         for chrc in self.characteristics:
@@ -117,19 +191,182 @@ class Service(dbus.service.Object):
 
         return self.get_properties()[GATT_SERVICE_IFACE]
 
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != GATT_SERVICE_IFACE or name != 'Handle':
+            raise exceptions.NotSupportedException()
+        self.handle = int(value)
+
 
 class Characteristic(dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, service):
+    # Seconds ReadValue results are cached for, None to not cache
+    read_cache_ttl = None
+    # Writes change the state of the writing connection only, and are not
+    # replayed into the other worker processes (see supervisor.Worker)
+    session_scoped = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        read_cache.cache_handlers(cls)
+        observers.observe_handlers(cls)
+
+    def __init__(self, bus, index, uuid, flags, service, value=None):
         self.path = service.path + '/char' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.service = service
         self.flags = flags
+        # Immutable value, serialized once and served by the base ReadValue
+        self.static_value = None if value is None else bytes(bytearray(value))
         self.descriptors = []
+        self.handle = 0
+        self.scheduler = clock.get_scheduler()
+        self._notifying = False
+        self.producers = []
+        self.active = False
+        self.demand_changed_at = self.scheduler.now()
+        self.active_time = 0.0
+        self.idle_time = 0.0
+        self.wakeups = 0
+        self.notify_filter = None
+        self.indications = indications.IndicationQueue(
+                self._send_indication, scheduler=self.scheduler,
+                subscribers=self.indication_subscribers)
         dbus.service.Object.__init__(self, bus, self.path)
+        observers.observe_signal(self, 'PropertiesChanged')
+        self.value_signal = value_signal.ValueSignal(self, GATT_CHRC_IFACE)
+
+    @property
+    def notifying(self):
+        return self._notifying
+
+    @notifying.setter
+    def notifying(self, value):
+        self._notifying = value
+        if not value:
+            self.indications.clear()
+        if self.producers:
+            self.update_demand()
+
+    def add_producer(self, interval, callback):
+        """
+        Call callback every interval milliseconds, like a scheduler timeout,
+        but only while has_demand() is true. The timer is removed when demand
+        goes away and added again when it comes back.
+
+        """
+        if not self.producers:
+            registry = adapters.get_registry(self.bus)
+            registry.add_connection_listener(self._connection_changed)
+        self.producers.append([interval, callback, None])
+        self.update_demand()
+
+    def has_demand(self):
+        """
+        True if a central is connected and subscribed to the value.
+
+        """
+        if not self.notifying:
+            return False
+        registry = adapters.get_registry(self.bus)
+        return any(registry.connected.values())
+
+    def update_demand(self):
+        active = self.has_demand()
+        if active == self.active:
+            return
+
+        now = self.scheduler.now()
+        if self.active:
+            self.active_time += now - self.demand_changed_at
+        else:
+            self.idle_time += now - self.demand_changed_at
+        self.demand_changed_at = now
+        self.active = active
+
+        for producer in self.producers:
+            if active and producer[2] is None:
+                producer[2] = self.scheduler.timeout_add(
+                        producer[0], functools.partial(self._produce, producer))
+            elif not active and producer[2] is not None:
+                self.scheduler.source_remove(producer[2])
+                producer[2] = None
+
+    def _produce(self, producer):
+        if not self.has_demand():
+            producer[2] = None
+            self.update_demand()
+            return False
+
+        self.wakeups += 1
+        if producer[1]():
+            return True
+        producer[2] = None
+        self.producers.remove(producer)
+        return False
+
+    def _connection_changed(self, device, adapter, connected):
+        self.update_demand()
+
+    def demand_times(self):
+        """
+        Return the seconds spent with and without demand for the value.
+
+        """
+        elapsed = self.scheduler.now() - self.demand_changed_at
+        if self.active:
+            return self.active_time + elapsed, self.idle_time
+        return self.active_time, self.idle_time + elapsed
+
+    def notify_value(self, value, force=False):
+        """
+        Send value to the subscribers, unless notify_filter (a
+        notify_filter.NotifyFilter) suppresses it. force sends it anyway, e.g.
+        to a new subscriber. Returns True if a notification was sent.
+
+        """
+        if not self.notifying:
+            return False
+        if self.notify_filter is not None:
+            if force:
+                self.notify_filter.reset()
+            if not self.notify_filter.accept(value):
+                return False
+        if 'indicate' in self.flags and 'notify' not in self.flags:
+            self.indicate_value(value)
+            return True
+        self.value_signal.emit(value)
+        return True
+
+    def indicate_value(self, value):
+        """
+        Queue value for indication. Indications go out one at a time, each
+        after the Confirm of the previous one (see
+        indications.IndicationQueue).
+
+        """
+        if not self.notifying:
+            return
+        self.indications.push(value)
+
+    def _send_indication(self, value):
+        self.value_signal.emit(value)
+
+    def indication_subscribers(self):
+        """
+        Devices an indication may go to. BlueZ does not say which centrals
+        subscribed, so these are all the connected ones; the queue learns how
+        many of them actually confirm.
+
+        """
+        registry = adapters.get_registry(self.bus)
+        devices = set()
+        for connected in registry.connected.values():
+            devices.update(connected)
+        return devices
 
     def get_properties(self):
         return {
@@ -137,6 +374,7 @@ class Characteristic(dbus.service.Object):
                         'Service': self.service.get_path(),
                         'UUID': self.uuid,
                         'Flags': self.flags,
+                        'Handle': dbus.UInt16(self.handle),
                         'Descriptors': dbus.Array(
                                 self.get_descriptor_paths(),
                                 signature='o')
@@ -158,6 +396,21 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
+    def invalidate_read_cache(self):
+        """
+        Drop the cached value, e.g. after the source of the value changed.
+
+        """
+        read_cache.invalidate(self)
+
+    def get_session(self, options):
+        """
+        Return the Session of the central that issued a handler call, or None
+        if options do not name a device.
+
+        """
+        return sessions.get_session_table(self.bus).get(options)
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -167,13 +420,30 @@ class Characteristic(dbus.service.Object):
 
         return self.get_properties()[GATT_CHRC_IFACE]
 
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != GATT_CHRC_IFACE or name != 'Handle':
+            raise exceptions.NotSupportedException()
+        self.handle = int(value)
+
     @dbus.service.method(GATT_CHRC_IFACE,
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
+        if self.static_value is not None:
+            # Long values are read in several requests with an offset
+            offset = options.get('offset')
+            if offset:
+                return self.static_value[int(offset):]
+            return self.static_value
+
         print('Default ReadValue called, returning error')
         raise exceptions.NotSupportedException()
 
+    # Static values are served by this handler itself; observe it like the
+    # handlers of the subclasses (the D-Bus method attributes are kept)
+    ReadValue = observers.observed('ReadValue', ReadValue)
+
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
         print('Default WriteValue called, returning error')
@@ -189,6 +459,10 @@ class Characteristic(dbus.service.Object):
         print('Default StopNotify called, returning error')
         raise exceptions.NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def Confirm(self):
+        self.indications.confirm()
+
     @dbus.service.signal(DBUS_PROP_IFACE,
                          signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
@@ -199,12 +473,22 @@ class Descriptor(dbus.service.Object):
     """
     org.bluez.GattDescriptor1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, characteristic):
+    # Seconds ReadValue results are cached for, None to not cache
+    read_cache_ttl = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        read_cache.cache_handlers(cls)
+        observers.observe_handlers(cls)
+
+    def __init__(self, bus, index, uuid, flags, characteristic, value=None):
         self.path = characteristic.path + '/desc' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.flags = flags
+        self.static_value = None if value is None else bytes(bytearray(value))
         self.chrc = characteristic
+        self.handle = 0
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -213,6 +497,7 @@ class Descriptor(dbus.service.Object):
                         'Characteristic': self.chrc.get_path(),
                         'UUID': self.uuid,
                         'Flags': self.flags,
+                        'Handle': dbus.UInt16(self.handle),
                 }
         }
 
@@ -228,13 +513,30 @@ class Descriptor(dbus.service.Object):
 
         return self.get_properties()[GATT_DESC_IFACE]
 
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != GATT_DESC_IFACE or name != 'Handle':
+            raise exceptions.NotSupportedException()
+        self.handle = int(value)
+
     @dbus.service.method(GATT_DESC_IFACE,
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
+        if self.static_value is not None:
+            # Long values are read in several requests with an offset
+            offset = options.get('offset')
+            if offset:
+                return self.static_value[int(offset):]
+            return self.static_value
+
         print('Default ReadValue called, returning error')
         raise exceptions.NotSupportedException()
 
+    # Static values are served by this handler itself; observe it like the
+    # handlers of the subclasses (the D-Bus method attributes are kept)
+    ReadValue = observers.observed('ReadValue', ReadValue)
+
     @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
         print('Default WriteValue called, returning error')
@@ -268,12 +570,13 @@ class HeartRateMeasurementChrc(Characteristic):
                 service)
         self.notifying = False
         self.hr_ee_count = 0
+        self.add_producer(1000, self.hr_msrmt_cb)
 
     def hr_msrmt_cb(self):
         value = []
         value.append(dbus.Byte(0x06))
 
-        value.append(dbus.Byte(randint(90, 130)))
+        value.append(dbus.Byte(self.scheduler.random.randint(90, 130)))
 
         if self.hr_ee_count % 10 == 0:
             value[0] = dbus.Byte(value[0] | 0x08)
@@ -286,17 +589,9 @@ class HeartRateMeasurementChrc(Characteristic):
 
         print('Updating value: ' + repr(value))
 
-        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
-
-        return self.notifying
+        self.notify_value(value)
 
-    def _update_hr_msrmt_simulation(self):
-        print('Update HR Measurement Simulation')
-
-        if not self.notifying:
-            return
-
-        GObject.timeout_add(1000, self.hr_msrmt_cb)
+        return True
 
     def StartNotify(self):
         if self.notifying:
@@ -304,7 +599,6 @@ class HeartRateMeasurementChrc(Characteristic):
             return
 
         self.notifying = True
-        self._update_hr_msrmt_simulation()
 
     def StopNotify(self):
         if not self.notifying:
@@ -312,7 +606,6 @@ class HeartRateMeasurementChrc(Characteristic):
             return
 
         self.notifying = False
-        self._update_hr_msrmt_simulation()
 
 
 class BodySensorLocationChrc(Characteristic):
@@ -323,11 +616,9 @@ class BodySensorLocationChrc(Characteristic):
                 self, bus, index,
                 self.BODY_SNSR_LOC_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        # Return 'Chest' as the sensor location.
-        return [ 0x01 ]
+                service,
+                # 'Chest'
+                value=b'\x01')
 
 class HeartRateControlPointChrc(Characteristic):
     HR_CTRL_PT_UUID = '00002a39-0000-1000-8000-00805f9b34fb'
@@ -383,14 +674,27 @@ class BatteryLevelCharacteristic(Characteristic):
                 service)
         self.notifying = False
         self.battery_lvl = 100
-        GObject.timeout_add(5000, self.drain_battery)
-
-    def notify_battery_level(self):
-        if not self.notifying:
-            return
-        self.PropertiesChanged(
-                GATT_CHRC_IFACE,
-                {'Value': [dbus.Byte(self.battery_lvl)] }, [])
+        # The level often stays put (or is stuck at 0), and sources jitter by
+        # a point; still tell subscribers every minute
+        self.notify_filter = notify_filter.NotifyFilter(deadband=1,
+                                                        max_quiet=60)
+        self.store = value_table.get_store()
+        source = data_sources.get_source('battery_level')
+        if source is not None:
+            # Battery level of a file or sysfs attribute (e.g. power_supply)
+            self.store = None
+            if source.value is not None:
+                self.battery_lvl = self.clamp_level(source.value)
+            source.add_callback(self.battery_source_changed)
+        elif self.store is not None:
+            # Battery level published by an external producer
+            self.store_index = self.store.bind('battery_level')
+            self.store.watch(self.store_index, self.battery_level_changed)
+        else:
+            self.add_producer(5000, self.drain_battery)
+
+    def notify_battery_level(self, force=False):
+        self.notify_value([dbus.Byte(self.battery_lvl)], force)
 
     def drain_battery(self):
         if self.battery_lvl > 0:
@@ -401,7 +705,32 @@ class BatteryLevelCharacteristic(Characteristic):
         self.notify_battery_level()
         return True
 
+    def battery_level_changed(self, value):
+        if not value:
+            return
+        self.battery_lvl = bytearray(value)[0]
+        print('Battery level: ' + repr(self.battery_lvl))
+        self.notify_battery_level()
+
+    def clamp_level(self, value):
+        return max(0, min(100, int(value)))
+
+    def battery_source_changed(self, value):
+        self.battery_lvl = self.clamp_level(value)
+        print('Battery level: ' + repr(self.battery_lvl))
+        self.notify_battery_level()
+
     def ReadValue(self, options):
+        if self.store is not None:
+            try:
+                value, seq = self.store.read(self.store_index)
+            except value_table.SlotBusy as e:
+                print('Battery level not readable from the store: %s' % e)
+                value, seq = None, 0
+            # Until the producer wrote a level, serve the simulated one
+            if seq and value:
+                return value
+
         print('Battery level read: ' + repr(self.battery_lvl))
         return [dbus.Byte(self.battery_lvl)]
 
@@ -411,7 +740,7 @@ class BatteryLevelCharacteristic(Characteristic):
             return
 
         self.notifying = True
-        self.notify_battery_level()
+        self.notify_battery_level(force=True)
 
     def StopNotify(self):
         if not self.notifying:
@@ -475,12 +804,8 @@ class TestDescriptor(Descriptor):
                 self, bus, index,
                 self.TEST_DESC_UUID,
                 ['read', 'write'],
-                characteristic)
-
-    def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+                characteristic,
+                value=b'Test')
 
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
@@ -546,12 +871,8 @@ class TestEncryptDescriptor(Descriptor):
                 self, bus, index,
                 self.TEST_DESC_UUID,
                 ['encrypt-read', 'encrypt-write'],
-                characteristic)
-
-    def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+                characteristic,
+                value=b'Test')
 
 
 class TestSecureCharacteristic(Characteristic):
@@ -593,12 +914,8 @@ class TestSecureDescriptor(Descriptor):
                 self, bus, index,
                 self.TEST_DESC_UUID,
                 ['secure-read', 'secure-write'],
-                characteristic)
-
-    def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+                characteristic,
+                value=b'Test')
 
 def register_app_cb():
     print('GATT application registered')
@@ -609,20 +926,64 @@ def register_app_error_cb(mainloop, error):
     mainloop.quit()
 
 
-def gatt_server_main(mainloop, bus, adapter_name):
-    adapter = adapters.find_adapter(bus, GATT_MANAGER_IFACE, adapter_name)
-    if not adapter:
-        raise Exception('GattManager1 interface not found')
-
+def register_app(mainloop, bus, adapter, app=None):
     service_manager = dbus.Interface(
             bus.get_object(BLUEZ_SERVICE_NAME, adapter),
             GATT_MANAGER_IFACE)
 
-    app = Application(bus)
+    if app is None:
+        app = Application(bus)
 
-    print('Registering GATT application...')
+    print('Registering GATT application on %s...' % adapter)
+    app.registered = True
 
     service_manager.RegisterApplication(app.get_path(), {},
                                     reply_handler=register_app_cb,
                                     error_handler=functools.partial(register_app_error_cb, mainloop))
 
+    return app
+
+
+def adapter_ready_cb(mainloop, bus, adapter):
+    if not adapter:
+        print('GattManager1 interface not found')
+        mainloop.quit()
+        return
+
+    register_app(mainloop, bus, adapter)
+
+
+def gatt_server_main(mainloop, bus, adapter_name, wait_timeout=None):
+    if wait_timeout is not None:
+        adapters.wait_for_adapter(bus, GATT_MANAGER_IFACE, adapter_name,
+                                  functools.partial(adapter_ready_cb, mainloop, bus),
+                                  wait_timeout)
+        return
+
+    adapter = adapters.find_adapter(bus, GATT_MANAGER_IFACE, adapter_name)
+    if not adapter:
+        raise Exception('GattManager1 interface not found')
+
+    return register_app(mainloop, bus, adapter)
+
+
+def gatt_server_multi_main(mainloop, bus, adapter_names):
+    """
+    Register a single Application on several adapters. The service tree, and
+    with it characteristic state and notifications, is shared by all of them.
+    An empty adapter_names list selects every adapter with GattManager1.
+
+    """
+    adapter_paths = adapters.find_adapters(bus, GATT_MANAGER_IFACE,
+                                           adapter_names)
+    if not adapter_paths:
+        raise Exception('GattManager1 interface not found')
+
+    app = Application(bus)
+    for adapter in adapter_paths:
+        register_app(mainloop, bus, adapter, app)
+
+    stats = adapters.AdapterStats(adapters.get_registry(bus), adapter_paths)
+    observers.add_observer(stats)
+
+    return app, stats
@@ -6,17 +6,31 @@ import dbus.service
 
 import array
 
+import collections
 import functools
+import socket
+import time
 
 try:
   from gi.repository import GObject
 except ImportError:
   import gobject as GObject
 
-from random import randint
-
 import exceptions
 import adapters
+import clock
+import connection_params
+import data_sources
+import indications
+import hid_descriptor
+import hid_stream
+import keyboard_layouts
+import notify_filter
+import observers
+import read_cache
+import sessions
+import value_signal
+import value_table
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
 LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
@@ -37,20 +51,76 @@ class Application(dbus.service.Object):
     """
     org.bluez.GattApplication1 interface implementation
     """
+    # Serve GenericAccessService, which carries the Peripheral Preferred
+    # Connection Parameters; bluetoothd serves a GAP service of its own
+    generic_access = False
+
     def __init__(self, bus):
         self.path = '/'
         self.services = []
+        self.registered = False
         dbus.service.Object.__init__(self, bus, self.path)
-        # self.add_service(GenericAccessService(bus, 0))
         # self.add_service(GenericAttributeService(bus, 1))
         self.add_service(BatteryService(bus, 0))
         self.add_service(HidService(bus, 1))
+        if self.generic_access:
+            self.add_service(GenericAccessService(bus, 2))
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
+        """
+        Add service. Once the application is registered, only the objects of
+        the new service are announced to BlueZ, with InterfacesAdded.
+
+        """
         self.services.append(service)
+        connection_params.get_policy().add_service(service)
+        self.publish(service)
+
+    def remove_service(self, service):
+        """
+        Remove service at runtime, with InterfacesRemoved for its objects.
+
+        """
+        self.services.remove(service)
+        connection_params.get_policy().remove_service(service)
+        self.unpublish(service)
+        for obj in service.get_objects():
+            obj.remove_from_connection()
+
+    def add_characteristic(self, service, chrc):
+        """
+        Add chrc to a published service. BlueZ allocates the handles of a
+        service in one block, so the service is removed and added again.
+
+        """
+        self.unpublish(service)
+        service.add_characteristic(chrc)
+        self.publish(service)
+
+    def remove_characteristic(self, service, chrc):
+        self.unpublish(service)
+        service.remove_characteristic(chrc)
+        chrc.remove_from_connection()
+        for desc in chrc.get_descriptors():
+            desc.remove_from_connection()
+        self.publish(service)
+
+    def publish(self, service):
+        # bluetoothd indicates Service Changed from its own GATT service
+        # when the services of an application are added or removed
+        if not self.registered:
+            return
+        for path, interfaces in service.get_managed_objects():
+            self.InterfacesAdded(path, interfaces)
+
+    def unpublish(self, service):
+        if not self.registered:
+            return
+        for path, interfaces in reversed(service.get_managed_objects()):
+            self.InterfacesRemoved(path, list(interfaces.keys()))
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
@@ -58,16 +128,17 @@ class Application(dbus.service.Object):
         print('GetManagedObjects')
 
         for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
+            response.update(service.get_managed_objects())
 
         return response
 
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
 
 class Service(dbus.service.Object):
     """
@@ -81,6 +152,7 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.handle = 0
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -88,6 +160,7 @@ class Service(dbus.service.Object):
                 GATT_SERVICE_IFACE: {
                         'UUID': self.uuid,
                         'Primary': self.primary,
+                        'Handle': dbus.UInt16(self.handle),
                         'Characteristics': dbus.Array(
                                 self.get_characteristic_paths(),
                                 signature='o')
@@ -100,6 +173,25 @@ class Service(dbus.service.Object):
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
 
+    def remove_characteristic(self, characteristic):
+        self.characteristics.remove(characteristic)
+
+    def get_objects(self):
+        """
+        The service, its characteristics and their descriptors, parents
+        first.
+
+        """
+        result = [self]
+        for chrc in self.characteristics:
+            result.append(chrc)
+            result.extend(chrc.get_descriptors())
+        return result
+
+    def get_managed_objects(self):
+        return [(obj.get_path(), obj.get_properties())
+                for obj in self.get_objects()]
+
     def get_characteristic_paths(self):
         result = []
         for chrc in self.characteristics:
@@ -118,18 +210,181 @@ class Service(dbus.service.Object):
 
         return self.get_properties()[GATT_SERVICE_IFACE]
 
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != GATT_SERVICE_IFACE or name != 'Handle':
+            raise exceptions.NotSupportedException()
+        self.handle = int(value)
+
 class Characteristic(dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, service):
+    # Seconds ReadValue results are cached for, None to not cache
+    read_cache_ttl = None
+    # Writes change the state of the writing connection only, and are not
+    # replayed into the other worker processes (see supervisor.Worker)
+    session_scoped = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        read_cache.cache_handlers(cls)
+        observers.observe_handlers(cls)
+
+    def __init__(self, bus, index, uuid, flags, service, value=None):
         self.path = service.path + '/char' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.service = service
         self.flags = flags
+        # Immutable value, serialized once and served by the base ReadValue
+        self.static_value = None if value is None else bytes(bytearray(value))
         self.descriptors = []
+        self.handle = 0
+        self.scheduler = clock.get_scheduler()
+        self._notifying = False
+        self.producers = []
+        self.active = False
+        self.demand_changed_at = self.scheduler.now()
+        self.active_time = 0.0
+        self.idle_time = 0.0
+        self.wakeups = 0
+        self.notify_filter = None
+        self.indications = indications.IndicationQueue(
+                self._send_indication, scheduler=self.scheduler,
+                subscribers=self.indication_subscribers)
         dbus.service.Object.__init__(self, bus, self.path)
+        observers.observe_signal(self, 'PropertiesChanged')
+        self.value_signal = value_signal.ValueSignal(self, GATT_CHRC_IFACE)
+
+    @property
+    def notifying(self):
+        return self._notifying
+
+    @notifying.setter
+    def notifying(self, value):
+        self._notifying = value
+        if not value:
+            self.indications.clear()
+        if self.producers:
+            self.update_demand()
+
+    def add_producer(self, interval, callback):
+        """
+        Call callback every interval milliseconds, like a scheduler timeout,
+        but only while has_demand() is true. The timer is removed when demand
+        goes away and added again when it comes back.
+
+        """
+        if not self.producers:
+            registry = adapters.get_registry(self.bus)
+            registry.add_connection_listener(self._connection_changed)
+        self.producers.append([interval, callback, None])
+        self.update_demand()
+
+    def has_demand(self):
+        """
+        True if a central is connected and subscribed to the value.
+
+        """
+        if not self.notifying:
+            return False
+        registry = adapters.get_registry(self.bus)
+        return any(registry.connected.values())
+
+    def update_demand(self):
+        active = self.has_demand()
+        if active == self.active:
+            return
+
+        now = self.scheduler.now()
+        if self.active:
+            self.active_time += now - self.demand_changed_at
+        else:
+            self.idle_time += now - self.demand_changed_at
+        self.demand_changed_at = now
+        self.active = active
+
+        for producer in self.producers:
+            if active and producer[2] is None:
+                producer[2] = self.scheduler.timeout_add(
+                        producer[0], functools.partial(self._produce, producer))
+            elif not active and producer[2] is not None:
+                self.scheduler.source_remove(producer[2])
+                producer[2] = None
+
+    def _produce(self, producer):
+        if not self.has_demand():
+            producer[2] = None
+            self.update_demand()
+            return False
+
+        self.wakeups += 1
+        if producer[1]():
+            return True
+        producer[2] = None
+        self.producers.remove(producer)
+        return False
+
+    def _connection_changed(self, device, adapter, connected):
+        self.update_demand()
+
+    def demand_times(self):
+        """
+        Return the seconds spent with and without demand for the value.
+
+        """
+        elapsed = self.scheduler.now() - self.demand_changed_at
+        if self.active:
+            return self.active_time + elapsed, self.idle_time
+        return self.active_time, self.idle_time + elapsed
+
+    def notify_value(self, value, force=False):
+        """
+        Send value to the subscribers, unless notify_filter (a
+        notify_filter.NotifyFilter) suppresses it. force sends it anyway, e.g.
+        to a new subscriber. Returns True if a notification was sent.
+
+        """
+        if not self.notifying:
+            return False
+        if self.notify_filter is not None:
+            if force:
+                self.notify_filter.reset()
+            if not self.notify_filter.accept(value):
+                return False
+        if 'indicate' in self.flags and 'notify' not in self.flags:
+            self.indicate_value(value)
+            return True
+        self.value_signal.emit(value)
+        return True
+
+    def indicate_value(self, value):
+        """
+        Queue value for indication. Indications go out one at a time, each
+        after the Confirm of the previous one (see
+        indications.IndicationQueue).
+
+        """
+        if not self.notifying:
+            return
+        self.indications.push(value)
+
+    def _send_indication(self, value):
+        self.value_signal.emit(value)
+
+    def indication_subscribers(self):
+        """
+        Devices an indication may go to. BlueZ does not say which centrals
+        subscribed, so these are all the connected ones; the queue learns how
+        many of them actually confirm.
+
+        """
+        registry = adapters.get_registry(self.bus)
+        devices = set()
+        for connected in registry.connected.values():
+            devices.update(connected)
+        return devices
 
     def get_properties(self):
         return {
@@ -137,6 +392,7 @@ class Characteristic(dbus.service.Object):
                         'Service': self.service.get_path(),
                         'UUID': self.uuid,
                         'Flags': self.flags,
+                        'Handle': dbus.UInt16(self.handle),
                         'Descriptors': dbus.Array(
                                 self.get_descriptor_paths(),
                                 signature='o')
@@ -158,6 +414,21 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
+    def invalidate_read_cache(self):
+        """
+        Drop the cached value, e.g. after the source of the value changed.
+
+        """
+        read_cache.invalidate(self)
+
+    def get_session(self, options):
+        """
+        Return the Session of the central that issued a handler call, or None
+        if options do not name a device.
+
+        """
+        return sessions.get_session_table(self.bus).get(options)
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -167,13 +438,30 @@ class Characteristic(dbus.service.Object):
 
         return self.get_properties()[GATT_CHRC_IFACE]
 
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != GATT_CHRC_IFACE or name != 'Handle':
+            raise exceptions.NotSupportedException()
+        self.handle = int(value)
+
     @dbus.service.method(GATT_CHRC_IFACE,
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
+        if self.static_value is not None:
+            # Long values are read in several requests with an offset
+            offset = options.get('offset')
+            if offset:
+                return self.static_value[int(offset):]
+            return self.static_value
+
         print(f'Default ReadValue called, returning error for {self.uuid}')
         raise exceptions.NotSupportedException()
 
+    # Static values are served by this handler itself; observe it like the
+    # handlers of the subclasses (the D-Bus method attributes are kept)
+    ReadValue = observers.observed('ReadValue', ReadValue)
+
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
         print('Default WriteValue called, returning error')
@@ -189,6 +477,10 @@ class Characteristic(dbus.service.Object):
         print('Default StopNotify called, returning error')
         raise exceptions.NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def Confirm(self):
+        self.indications.confirm()
+
     @dbus.service.signal(DBUS_PROP_IFACE,
                          signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
@@ -198,12 +490,22 @@ class Descriptor(dbus.service.Object):
     """
     org.bluez.GattDescriptor1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, characteristic):
+    # Seconds ReadValue results are cached for, None to not cache
+    read_cache_ttl = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        read_cache.cache_handlers(cls)
+        observers.observe_handlers(cls)
+
+    def __init__(self, bus, index, uuid, flags, characteristic, value=None):
         self.path = characteristic.path + '/desc' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.flags = flags
+        self.static_value = None if value is None else bytes(bytearray(value))
         self.chrc = characteristic
+        self.handle = 0
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -212,6 +514,7 @@ class Descriptor(dbus.service.Object):
                         'Characteristic': self.chrc.get_path(),
                         'UUID': self.uuid,
                         'Flags': self.flags,
+                        'Handle': dbus.UInt16(self.handle),
                 }
         }
 
@@ -227,13 +530,30 @@ class Descriptor(dbus.service.Object):
 
         return self.get_properties()[GATT_DESC_IFACE]
 
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface != GATT_DESC_IFACE or name != 'Handle':
+            raise exceptions.NotSupportedException()
+        self.handle = int(value)
+
     @dbus.service.method(GATT_DESC_IFACE,
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
+        if self.static_value is not None:
+            # Long values are read in several requests with an offset
+            offset = options.get('offset')
+            if offset:
+                return self.static_value[int(offset):]
+            return self.static_value
+
         print('Default ReadValue called, returning error')
         raise exceptions.NotSupportedException()
 
+    # Static values are served by this handler itself; observe it like the
+    # handlers of the subclasses (the D-Bus method attributes are kept)
+    ReadValue = observers.observed('ReadValue', ReadValue)
+
     @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
         print('Default WriteValue called, returning error')
@@ -271,7 +591,7 @@ class HeartRateMeasurementChrc(Characteristic):
         value = []
         value.append(dbus.Byte(0x06))
 
-        value.append(dbus.Byte(randint(90, 130)))
+        value.append(dbus.Byte(self.scheduler.random.randint(90, 130)))
 
         if self.hr_ee_count % 10 == 0:
             value[0] = dbus.Byte(value[0] | 0x08)
@@ -294,7 +614,7 @@ class HeartRateMeasurementChrc(Characteristic):
         if not self.notifying:
             return
 
-        GObject.timeout_add(1000, self.hr_msrmt_cb)
+        self.scheduler.timeout_add(1000, self.hr_msrmt_cb)
 
     def StartNotify(self):
         if self.notifying:
@@ -320,11 +640,9 @@ class BodySensorLocationChrc(Characteristic):
                 self, bus, index,
                 self.BODY_SNSR_LOC_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        # Return 'Chest' as the sensor location.
-        return [ 0x01 ]
+                service,
+                # 'Chest'
+                value=b'\x01')
 
 class HeartRateControlPointChrc(Characteristic):
     HR_CTRL_PT_UUID = '00002a39-0000-1000-8000-00805f9b34fb'
@@ -375,11 +693,8 @@ class DeviceNameChrc(Characteristic):
                 self, bus, index,
                 self.DEVICE_NAME_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        print('Device Name Read: ' + repr('PyGATTTS'))
-        return ['P', 'y', 'G', 'A', 'T', 'T', 'T']
+                service,
+                value=b'PyGATTT')
 
 class AppearanceChrc(Characteristic):
     APPEARANCE_UUID = '00002a01-0000-1000-8000-00805f9b34fb'
@@ -389,12 +704,9 @@ class AppearanceChrc(Characteristic):
                 self, bus, index,
                 self.APPEARANCE_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        # Generic Computer
-        print('Appearance Read: ' + repr([0x00, 0x80]))
-        return [ dbus.Byte(0x00), dbus.Byte(0x80) ]
+                service,
+                # Generic Computer
+                value=b'\x00\x80')
 
 class PeripheralPrivacyFlagChrc(Characteristic):
     PERIPHERAL_PRIVACY_FLAG_UUID = '00002a02-0000-1000-8000-00805f9b34fb'
@@ -404,12 +716,9 @@ class PeripheralPrivacyFlagChrc(Characteristic):
                 self, bus, index,
                 self.PERIPHERAL_PRIVACY_FLAG_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        # Peripheral Privacy Flag is disabled
-        print('Peripheral Privacy Flag Read: ' + repr([0x00]))
-        return [ dbus.Byte(0x00) ]
+                service,
+                # Peripheral Privacy Flag is disabled
+                value=b'\x00')
 
 class ReconnectionAddressChrc(Characteristic):
     RECONNECTION_ADDRESS_UUID = '00002a03-0000-1000-8000-00805f9b34fb'
@@ -419,26 +728,33 @@ class ReconnectionAddressChrc(Characteristic):
                 self, bus, index,
                 self.RECONNECTION_ADDRESS_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        # Reconnection Address is not set
-        return [ dbus.Byte(0x00) ] * 6
+                service,
+                # Reconnection Address is not set
+                value=bytes(6))
 
 class PeripheralPreferredConnectionParametersChrc(Characteristic):
+    """
+    Preferred connection parameters of the ConnectionPolicy, kept current as
+    services are added and removed or the profile changes.
+
+    """
     PERIPHERAL_PREFERRED_CONNECTION_PARAMETERS_UUID = '00002a04-0000-1000-8000-00805f9b34fb'
 
-    def __init__(self, bus, index, service):
+    def __init__(self, bus, index, service, policy=None):
+        if policy is None:
+            policy = connection_params.get_policy()
         Characteristic.__init__(
                 self, bus, index,
                 self.PERIPHERAL_PREFERRED_CONNECTION_PARAMETERS_UUID,
                 ['read'],
-                service)
+                service,
+                # All zero while no service or profile asks for parameters
+                value=connection_params.encode(policy.parameters()))
+        policy.add_listener(self.parameters_changed)
 
-    def ReadValue(self, options):
-        # Peripheral Preferred Connection Parameters are not set
-        print(  'Peripheral Preferred Connection Parameters Read: ---not set---')
-        return [ dbus.Byte(0x00) ] * 8
+    def parameters_changed(self, parameters):
+        self.static_value = connection_params.encode(parameters)
+        self.invalidate_read_cache()
 
 
 class GenericAttributeService(Service):
@@ -461,28 +777,156 @@ class ServiceChangedChrc(Characteristic):
                 self.SERVICE_CHANGED_UUID,
                 ['indicate'],
                 service)
+        self.notifying = False
 
     def StartNotify(self):
         print('Service Changed StartNotify called')
+        self.notifying = True
 
     def StopNotify(self):
         print('Service Changed StopNotify called')
+        self.notifying = False
 
 
 class HidService(Service):
     """
-    Fake HID service that emulates a keyboard.
+    Fake HID service that emulates a keyboard and a mouse.
+
+    The report map is compiled from the report descriptions in reports, and
+    one Report characteristic with a Report Reference descriptor is created
+    per input report ID.
 
     """
     HID_UUID = '1812'
+    connection_profile = 'low-latency'
 
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, reports=hid_descriptor.DEFAULT_REPORTS):
         Service.__init__(self, bus, index, self.HID_UUID, True)
+        self.layout = keyboard_layouts.get_layout('us')
+        self.report_descriptor = hid_descriptor.ReportDescriptor(reports)
         self.add_characteristic(HidReportMapCharacteristic(bus, 0, self))
         self.add_characteristic(HidInfoCharacteristic(bus, 1, self))
         self.add_characteristic(HidControlPointCharacteristic(bus, 2, self))
-        self.add_characteristic(HidReportCharacteristic(bus, 3, self))
-        self.add_characteristic(HidProtocolModeCharacteristic(bus, 4, self))
+        self.protocol_mode_characteristic = HidProtocolModeCharacteristic(
+                bus, 3, self)
+        self.add_characteristic(self.protocol_mode_characteristic)
+
+        self.leds = hid_stream.LedState()
+        self.report_characteristic = None
+        self.mouse_characteristic = None
+        # Boot protocol characteristics, added after the report ones; the
+        # report characteristics look them up as soon as they are created
+        self.boot_keyboard_input = None
+        self.boot_mouse_input = None
+        self.reports_by_id = [None] * 256
+        self.output_reports_by_id = [None] * 256
+        chrc_index = 4
+        for report in self.report_descriptor.reports:
+            if self.report_descriptor.report_size(
+                    report.report_id, hid_descriptor.REPORT_TYPE_OUTPUT):
+                chrc = HidOutputReportCharacteristic(bus, chrc_index, self,
+                                                     report)
+                chrc_index += 1
+                self.add_characteristic(chrc)
+                self.output_reports_by_id[report.report_id] = chrc
+                if report.kind == 'keyboard':
+                    chrc.add_callback(self.leds.update)
+
+            if not self.report_descriptor.report_size(report.report_id):
+                continue
+
+            cls = REPORT_CHARACTERISTICS.get(report.kind,
+                                             HidReportCharacteristic)
+            chrc = cls(bus, chrc_index, self, report)
+            chrc_index += 1
+            self.add_characteristic(chrc)
+            self.reports_by_id[report.report_id] = chrc
+            if report.kind == 'keyboard' and self.report_characteristic is None:
+                self.report_characteristic = chrc
+            if report.kind == 'mouse' and self.mouse_characteristic is None:
+                self.mouse_characteristic = chrc
+
+        if self.report_characteristic is not None:
+            self.boot_keyboard_input = BootKeyboardInputCharacteristic(
+                    bus, chrc_index, self)
+            self.add_characteristic(self.boot_keyboard_input)
+            self.add_characteristic(BootKeyboardOutputCharacteristic(
+                    bus, chrc_index + 1, self))
+            chrc_index += 2
+        if self.mouse_characteristic is not None:
+            self.boot_mouse_input = BootMouseInputCharacteristic(
+                    bus, chrc_index, self)
+            self.add_characteristic(self.boot_mouse_input)
+            chrc_index += 1
+
+        self.sessions = sessions.get_session_table(bus)
+        self.sessions.add_close_listener(self._session_closed)
+        self.boot_hosts = set()
+
+    def add_led_callback(self, callback):
+        """
+        Call callback(leds, changed) when the host changes the keyboard LEDs
+        (Caps Lock etc.), in report or boot protocol mode.
+
+        """
+        self.leds.add_callback(callback)
+
+    def protocol_mode_changed(self, session, mode):
+        # The mode of calls without a device is kept by the Protocol Mode
+        # characteristic itself
+        if session is not None and mode == sessions.PROTOCOL_MODE_BOOT:
+            self.boot_hosts.add(session.device)
+        elif session is not None:
+            self.boot_hosts.discard(session.device)
+
+        # Streams paused for lack of subscribers on the old path may be able
+        # to go on through the new one
+        if self.report_characteristic is not None:
+            self.report_characteristic.resume()
+        if self.mouse_characteristic is not None:
+            self.mouse_characteristic.resume()
+
+    def _session_closed(self, session):
+        self.boot_hosts.discard(session.device)
+
+    def uses_boot_protocol(self):
+        return bool(self.boot_hosts) or \
+                self.protocol_mode_characteristic.protocol_mode == \
+                sessions.PROTOCOL_MODE_BOOT
+
+    def uses_report_protocol(self):
+        """
+        True if some host is in report protocol mode. Hosts that never
+        selected a mode are in report mode.
+
+        """
+        if not len(self.sessions):
+            return self.protocol_mode_characteristic.protocol_mode == \
+                    sessions.PROTOCOL_MODE_REPORT
+        return len(self.sessions) > len(self.boot_hosts)
+
+    def send_report(self, report_id, data):
+        """
+        Send an input report through the characteristic of its report ID.
+
+        """
+        chrc = self.reports_by_id[report_id]
+        if chrc is None:
+            raise KeyError('no input report with ID %d' % report_id)
+        chrc.send_report(data)
+
+    def set_layout(self, name):
+        self.layout = keyboard_layouts.get_layout(name)
+        self.report_characteristic.pipeline.layout = self.layout
+
+    def type_text(self, text):
+        """
+        Type text on the host. The whole string is encoded into reports in one
+        pass, then streamed at the connection rate.
+
+        """
+        self.report_characteristic.pipeline.feed_encoded(
+                self.layout.encode(text))
 
 class HidReportMapCharacteristic(Characteristic):
     """
@@ -496,48 +940,8 @@ class HidReportMapCharacteristic(Characteristic):
                 self, bus, index,
                 self.HID_REPORT_MAP_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        print('HID Report Map read')
-        # return [dbus.Byte(0x05), dbus.Byte(0x01), dbus.Byte(0x09),
-        #         dbus.Byte(0x06), dbus.Byte(0xA1), dbus.Byte(0x01),
-        #         dbus.Byte(0x85), dbus.Byte(0x01), dbus.Byte(0x05),
-        #         dbus.Byte(0x07), dbus.Byte(0x19), dbus.Byte(0xE0),
-        #         dbus.Byte(0x29), dbus.Byte(0xE7), dbus.Byte(0x15),
-        #         dbus.Byte(0x00), dbus.Byte(0x25), dbus.Byte(0x01),
-        #         dbus.Byte(0x75), dbus.Byte(0x01), dbus.Byte(0x95),
-        #         dbus.Byte(0x08), dbus.Byte(0x81), dbus.Byte(0x02),
-        #         dbus.Byte(0x95), dbus.Byte(0x01), dbus.Byte(0x75),
-        #         dbus.Byte(0x08), dbus.Byte(0x81), dbus.Byte(0x01),
-        #         dbus.Byte(0x95), dbus.Byte(0x05), dbus.Byte(0x75),
-        #         dbus.Byte(0x01), dbus.Byte(0x05), dbus.Byte(0x08),
-        #         dbus.Byte(0x19), dbus.Byte(0x01), dbus.Byte(0x29),
-        #         dbus.Byte(0x05), dbus.Byte(0x91), dbus.Byte(0x02),
-        #         dbus.Byte(0x95), dbus.Byte(0x01), dbus.Byte(0x75),
-        #         dbus.Byte(0x03), dbus.Byte(0x91), dbus.Byte(0x01),
-        #         dbus.Byte(0x95), dbus.Byte(0x06), dbus.Byte(0x75),
-        #         dbus.Byte(0x08), dbus.Byte(0x15), dbus.Byte(0x00),
-        #         dbus.Byte(0x25), dbus.Byte(0x65), dbus.Byte(0x05),
-        #         dbus.Byte(0x07), dbus.Byte(0x19), dbus.Byte(0x00),
-        #         dbus.Byte(0x29), dbus.Byte(0x65), dbus.Byte(0x81),
-        #         dbus.Byte(0x00), dbus.Byte(0xC0)]
-
-
-
-
-
-
-
-
-        return [dbus.Byte(0x05), dbus.Byte(0x01), dbus.Byte(0x09),
-                dbus.Byte(0x06), dbus.Byte(0xA1), dbus.Byte(0x01),
-                dbus.Byte(0x85), dbus.Byte(0x01), dbus.Byte(0x05),
-                dbus.Byte(0x07), dbus.Byte(0x19), dbus.Byte(0xE0),
-                dbus.Byte(0x29), dbus.Byte(0xE7), dbus.Byte(0x15),
-                dbus.Byte(0x00), dbus.Byte(0x25), dbus.Byte(0x01),
-                dbus.Byte(0x75), dbus.Byte(0x01), dbus.Byte(0x95),
-                dbus.Byte(0x08), dbus.Byte(0xc0)]
+                service,
+                value=service.report_descriptor.data)
 
 class HidInfoCharacteristic(Characteristic):
     """
@@ -551,12 +955,8 @@ class HidInfoCharacteristic(Characteristic):
                 self, bus, index,
                 self.HID_INFO_UUID,
                 ['read'],
-                service)
-
-    def ReadValue(self, options):
-        print('HID Info read')
-        return [dbus.Byte(0x01), dbus.Byte(0x01), dbus.Byte(0x00),
-                dbus.Byte(0x03)]
+                service,
+                value=b'\x01\x01\x00\x03')
 
 class HidControlPointCharacteristic(Characteristic):
     """
@@ -564,6 +964,7 @@ class HidControlPointCharacteristic(Characteristic):
 
     """
     HID_CONTROL_POINT_UUID = '2a4c'
+    session_scoped = True
 
     def __init__(self, bus, index, service):
         Characteristic.__init__(
@@ -584,25 +985,65 @@ class HidControlPointCharacteristic(Characteristic):
 
 class HidReportCharacteristic(Characteristic):
     """
-    HID Report characteristic.
+    HID Report characteristic of one input report ID.
 
     """
     HID_REPORT_UUID = '2a4d'
 
-    A_VALUE = [ dbus.Byte(0x02), dbus.Byte(0x00), dbus.Byte(0x08),
-                dbus.Byte(0x00), dbus.Byte(0x00), dbus.Byte(0x00),
-                dbus.Byte(0x00), dbus.Byte(0x00)]
-
-    def __init__(self, bus, index, service):
+    def __init__(self, bus, index, service, report):
         Characteristic.__init__(
                 self, bus, index,
                 self.HID_REPORT_UUID,
                 ['read', 'notify'],
                 service)
         self.notifying = False
+        self.report = report
+        size = service.report_descriptor.report_size(report.report_id)
+        self.value = dbus.ByteArray(bytes(size))
+        self.add_descriptor(ReportReferenceDescriptor(
+                bus, 0, self, report.report_id,
+                hid_descriptor.REPORT_TYPE_INPUT))
+
+    def is_streaming(self):
+        return self.notifying
+
+    def send_report(self, report):
+        self.value = dbus.ByteArray(bytes(report))
+        if not self.notifying:
+            return
+        self.value_signal.emit(self.value)
+
+    def ReadValue(self, options):
+        print('Report %d read' % self.report.report_id)
+        return self.value
+
+    def StartNotify(self):
+        if self.notifying:
+            print('Already notifying, nothing to do')
+            return
+
+        self.notifying = True
+
+    def StopNotify(self):
+        if not self.notifying:
+            print('Not notifying, nothing to do')
+            return
+
+        self.notifying = False
+
+class HidKeyboardReportCharacteristic(HidReportCharacteristic):
+    """
+    Keyboard input report. Key events are streamed to the host through a
+    KeyReportPipeline; as a demo, a letter is typed every 5 seconds.
+
+    """
+    def __init__(self, bus, index, service, report):
+        HidReportCharacteristic.__init__(self, bus, index, service, report)
         self.key_pressed = 'a'
-        print("HidReportCharacteristic init")
-        GObject.timeout_add(5000, self.change_letter)
+        self.pipeline = hid_stream.KeyReportPipeline(
+                self, layout=service.layout, scheduler=self.scheduler)
+        print("HidKeyboardReportCharacteristic init")
+        self.add_producer(5000, self.change_letter)
 
     def change_letter(self):
         print("change_letter")
@@ -619,32 +1060,218 @@ class HidReportCharacteristic(Characteristic):
             return
         print('notify_key_pressed: ' + self.key_pressed)
 
-        # value = [dbus.Byte(0x02), dbus.Byte(0x00), dbus.Byte(0x00),
-        #          dbus.Byte(0x00), dbus.Byte(0x00), dbus.Byte(0x00),
-        #          dbus.Byte(0x00), dbus.Byte(0x00)]
-        # value[2] = dbus.Byte(ord(self.key_pressed))
+        self.pipeline.push(self.key_pressed)
 
-        self.PropertiesChanged(
-            GATT_CHRC_IFACE,
-            {'Value': A_VALUE }, [])
+    def type_keys(self, keys):
+        """
+        Stream an iterable of characters or (modifier, usage) tuples.
 
-    def ReadValue(self, options):
-        print('Letter read: ' + (self.key_pressed))
-        return A_VALUE
+        """
+        self.pipeline.feed(keys)
+
+    def is_streaming(self):
+        boot_input = self.service.boot_keyboard_input
+        if self.notifying and self.service.uses_report_protocol():
+            return True
+        return boot_input is not None and boot_input.notifying and \
+                self.service.uses_boot_protocol()
+
+    def send_report(self, report):
+        if self.service.uses_boot_protocol():
+            self.service.boot_keyboard_input.send_report(report)
+        if self.service.uses_report_protocol():
+            HidReportCharacteristic.send_report(self, report)
+
+    def has_demand(self):
+        if not self.is_streaming():
+            return False
+        registry = adapters.get_registry(self.bus)
+        return any(registry.connected.values())
+
+    def resume(self):
+        self.pipeline.resume()
+        self.update_demand()
 
     def StartNotify(self):
-        if self.notifying:
-            print('Already notifying, nothing to do')
-            return
+        HidReportCharacteristic.StartNotify(self)
+        self.pipeline.resume()
 
-        self.notifying = True
+class HidMouseReportCharacteristic(HidReportCharacteristic):
+    """
+    Mouse input report. Motion from a high rate source is merged by a
+    MotionCoalescer and sent as one report per connection interval.
 
-    def StopNotify(self):
-        if not self.notifying:
-            print('Not notifying, nothing to do')
-            return
+    """
+    def __init__(self, bus, index, service, report, interval=8):
+        HidReportCharacteristic.__init__(self, bus, index, service, report)
+        self.interval = interval
+        self.coalescer = hid_stream.MotionCoalescer()
+        self.timer = None
+
+    def move(self, dx, dy, wheel=0):
+        self.coalescer.move(dx, dy, wheel, self.scheduler.now())
+        self._schedule()
+
+    def set_buttons(self, buttons):
+        self.coalescer.set_buttons(buttons, self.scheduler.now())
+        self._schedule()
+
+    def _schedule(self):
+        if self.timer is None and self.is_streaming():
+            self.timer = self.scheduler.timeout_add(self.interval, self.flush)
+
+    def is_streaming(self):
+        boot_input = self.service.boot_mouse_input
+        if self.notifying and self.service.uses_report_protocol():
+            return True
+        return boot_input is not None and boot_input.notifying and \
+                self.service.uses_boot_protocol()
+
+    def send_report(self, report):
+        if self.service.uses_boot_protocol():
+            self.service.boot_mouse_input.send_report(report)
+        if self.service.uses_report_protocol():
+            HidReportCharacteristic.send_report(self, report)
+
+    def flush(self):
+        report = self.coalescer.flush(self.scheduler.now())
+        if report is not None:
+            self.send_report(report)
+
+        if not self.coalescer.pending():
+            self.timer = None
+            return False
+        return True
 
-        self.notifying = False
+    def StartNotify(self):
+        HidReportCharacteristic.StartNotify(self)
+        self.resume()
+
+    def resume(self):
+        if self.coalescer.pending():
+            self._schedule()
+
+class HidOutputReportCharacteristic(Characteristic):
+    """
+    HID Report characteristic of one output report ID, e.g. the keyboard
+    LEDs. Reports arrive through WriteValue or, once BlueZ acquired it,
+    through the socket returned by AcquireWrite. Callbacks are called with
+    the report data right away, and the time spent from reception to the
+    end of the callbacks is kept in latencies (seconds).
+
+    """
+    HID_REPORT_UUID = '2a4d'
+
+    def __init__(self, bus, index, service, report):
+        Characteristic.__init__(
+                self, bus, index,
+                self.HID_REPORT_UUID,
+                ['read', 'write', 'write-without-response'],
+                service)
+        self.report = report
+        self.size = service.report_descriptor.report_size(
+                report.report_id, hid_descriptor.REPORT_TYPE_OUTPUT)
+        self.value = bytes(self.size)
+        self.callbacks = []
+        self.latencies = collections.deque(maxlen=1024)
+        self.write_socket = None
+        self.write_mtu = None
+        self.add_descriptor(ReportReferenceDescriptor(
+                bus, 0, self, report.report_id,
+                hid_descriptor.REPORT_TYPE_OUTPUT))
+
+    def get_properties(self):
+        properties = Characteristic.get_properties(self)
+        properties[GATT_CHRC_IFACE]['WriteAcquired'] = \
+                dbus.Boolean(self.write_socket is not None)
+        return properties
+
+    def add_callback(self, callback):
+        """
+        Call callback(data) for every output report received.
+
+        """
+        self.callbacks.append(callback)
+
+    def dispatch(self, data, received):
+        self.value = bytes(data)
+        for callback in list(self.callbacks):
+            callback(self.value)
+        self.latencies.append(time.monotonic() - received)
+
+    def ReadValue(self, options):
+        return self.value
+
+    def WriteValue(self, value, options):
+        received = time.monotonic()
+        if len(value) != self.size:
+            raise exceptions.InvalidValueLengthException()
+        self.dispatch(bytearray(value), received)
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireWrite(self, options):
+        if self.write_socket is not None:
+            raise exceptions.NotPermittedException()
+
+        self.write_mtu = int(options.get('mtu', 23))
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.setblocking(False)
+        self.write_socket = ours
+        GObject.io_add_watch(ours.fileno(),
+                             GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                             self._write_socket_cb)
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        print('Output report %d write acquired, MTU %d' %
+              (self.report.report_id, self.write_mtu))
+        return fd, dbus.UInt16(self.write_mtu)
+
+    def _write_socket_cb(self, fd, condition):
+        if condition & GObject.IO_IN:
+            received = time.monotonic()
+            try:
+                data = self.write_socket.recv(self.write_mtu)
+            except BlockingIOError:
+                return True
+            if data:
+                if len(data) == self.size:
+                    self.dispatch(data, received)
+                return True
+
+        print('Output report %d write released' % self.report.report_id)
+        self.write_socket.close()
+        self.write_socket = None
+        return False
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        values = sorted(self.latencies)
+        if not values:
+            return {}
+        return dict((p, values[min(len(values) - 1, len(values) * p // 100)])
+                    for p in percentiles)
+
+REPORT_CHARACTERISTICS = {
+    'keyboard': HidKeyboardReportCharacteristic,
+    'mouse': HidMouseReportCharacteristic,
+}
+
+class ReportReferenceDescriptor(Descriptor):
+    """
+    Report Reference descriptor: report ID and report type of its Report
+    characteristic.
+
+    """
+    REPORT_REFERENCE_UUID = '2908'
+
+    def __init__(self, bus, index, characteristic, report_id, report_type):
+        Descriptor.__init__(
+                self, bus, index,
+                self.REPORT_REFERENCE_UUID,
+                ['read'],
+                characteristic,
+                value=bytes([report_id, report_type]))
 
 class HidProtocolModeCharacteristic(Characteristic):
     """
@@ -652,28 +1279,123 @@ class HidProtocolModeCharacteristic(Characteristic):
 
     """
     HID_PROTOCOL_MODE_UUID = '2a4e'
+    session_scoped = True
 
     def __init__(self, bus, index, service):
         Characteristic.__init__(
                 self, bus, index,
                 self.HID_PROTOCOL_MODE_UUID,
-                ['read', 'write'],
+                ['read', 'write', 'write-without-response'],
                 service)
+        # Used for calls that do not name a device
+        self.protocol_mode = sessions.PROTOCOL_MODE_REPORT
 
     def ReadValue(self, options):
-        print('HID Protocol Mode read')
-        return [dbus.Byte(0x01)]
+        session = self.get_session(options)
+        mode = session.protocol_mode if session else self.protocol_mode
+        print('HID Protocol Mode read: ' + repr(mode))
+        return [dbus.Byte(mode)]
 
     def WriteValue(self, value, options):
         print('HID Protocol Mode write: ' + repr(value))
         byte = value[0]
         print('Protocol Mode value: ' + repr(byte))
 
-        if byte != 0 and byte != 1:
+        if byte != sessions.PROTOCOL_MODE_BOOT and \
+                byte != sessions.PROTOCOL_MODE_REPORT:
             raise exceptions.FailedException("0x80")
 
+        session = self.get_session(options)
+        if session is not None:
+            session.protocol_mode = int(byte)
+        else:
+            self.protocol_mode = int(byte)
+        self.service.protocol_mode_changed(session, int(byte))
+
         print('Protocol Mode changed to ' + repr(byte))
 
+class BootKeyboardInputCharacteristic(HidReportCharacteristic):
+    """
+    Boot Keyboard Input Report characteristic, used by hosts in boot
+    protocol mode. Boot keyboard reports have the same 8-byte layout as our
+    keyboard input report.
+
+    """
+    HID_REPORT_UUID = '2a22'
+
+    def __init__(self, bus, index, service):
+        Characteristic.__init__(
+                self, bus, index,
+                self.HID_REPORT_UUID,
+                ['read', 'notify'],
+                service)
+        self.notifying = False
+        self.value = dbus.ByteArray(bytes(8))
+
+    def ReadValue(self, options):
+        print('Boot Keyboard Input read')
+        return self.value
+
+    def StartNotify(self):
+        HidReportCharacteristic.StartNotify(self)
+        self.service.report_characteristic.resume()
+
+    def StopNotify(self):
+        HidReportCharacteristic.StopNotify(self)
+        self.service.report_characteristic.update_demand()
+
+class BootKeyboardOutputCharacteristic(Characteristic):
+    """
+    Boot Keyboard Output Report characteristic (LED state in boot mode).
+
+    """
+    BOOT_KEYBOARD_OUTPUT_UUID = '2a32'
+
+    def __init__(self, bus, index, service):
+        Characteristic.__init__(
+                self, bus, index,
+                self.BOOT_KEYBOARD_OUTPUT_UUID,
+                ['read', 'write', 'write-without-response'],
+                service)
+        self.value = [dbus.Byte(0)]
+
+    def ReadValue(self, options):
+        return self.value
+
+    def WriteValue(self, value, options):
+        if len(value) != 1:
+            raise exceptions.InvalidValueLengthException()
+        print('Boot Keyboard Output write: ' + repr(value))
+        self.value = value
+        self.service.leds.update(bytearray(value))
+
+class BootMouseInputCharacteristic(HidReportCharacteristic):
+    """
+    Boot Mouse Input Report characteristic: buttons, X and Y, one byte each.
+
+    """
+    HID_REPORT_UUID = '2a33'
+
+    def __init__(self, bus, index, service):
+        Characteristic.__init__(
+                self, bus, index,
+                self.HID_REPORT_UUID,
+                ['read', 'notify'],
+                service)
+        self.notifying = False
+        self.value = dbus.ByteArray(bytes(3))
+
+    def send_report(self, report):
+        HidReportCharacteristic.send_report(self, report[:3])
+
+    def ReadValue(self, options):
+        print('Boot Mouse Input read')
+        return self.value
+
+    def StartNotify(self):
+        HidReportCharacteristic.StartNotify(self)
+        self.service.mouse_characteristic.resume()
+
 
 class BatteryService(Service):
     """
@@ -681,6 +1403,7 @@ class BatteryService(Service):
 
     """
     BATTERY_UUID = '180f'
+    connection_profile = 'low-power'
 
     def __init__(self, bus, index):
         Service.__init__(self, bus, index, self.BATTERY_UUID, True)
@@ -703,14 +1426,27 @@ class BatteryLevelCharacteristic(Characteristic):
                 service)
         self.notifying = False
         self.battery_lvl = 100
-        GObject.timeout_add(5000, self.drain_battery)
-
-    def notify_battery_level(self):
-        if not self.notifying:
-            return
-        self.PropertiesChanged(
-                GATT_CHRC_IFACE,
-                {'Value': [dbus.Byte(self.battery_lvl)] }, [])
+        # The level often stays put (or is stuck at 0), and sources jitter by
+        # a point; still tell subscribers every minute
+        self.notify_filter = notify_filter.NotifyFilter(deadband=1,
+                                                        max_quiet=60)
+        self.store = value_table.get_store()
+        source = data_sources.get_source('battery_level')
+        if source is not None:
+            # Battery level of a file or sysfs attribute (e.g. power_supply)
+            self.store = None
+            if source.value is not None:
+                self.battery_lvl = self.clamp_level(source.value)
+            source.add_callback(self.battery_source_changed)
+        elif self.store is not None:
+            # Battery level published by an external producer
+            self.store_index = self.store.bind('battery_level')
+            self.store.watch(self.store_index, self.battery_level_changed)
+        else:
+            self.add_producer(5000, self.drain_battery)
+
+    def notify_battery_level(self, force=False):
+        self.notify_value([dbus.Byte(self.battery_lvl)], force)
 
     def drain_battery(self):
         if self.battery_lvl >= 0:
@@ -721,7 +1457,32 @@ class BatteryLevelCharacteristic(Characteristic):
         self.notify_battery_level()
         return True
 
+    def battery_level_changed(self, value):
+        if not value:
+            return
+        self.battery_lvl = bytearray(value)[0]
+        print('Battery level: ' + repr(self.battery_lvl))
+        self.notify_battery_level()
+
+    def clamp_level(self, value):
+        return max(0, min(100, int(value)))
+
+    def battery_source_changed(self, value):
+        self.battery_lvl = self.clamp_level(value)
+        print('Battery level: ' + repr(self.battery_lvl))
+        self.notify_battery_level()
+
     def ReadValue(self, options):
+        if self.store is not None:
+            try:
+                value, seq = self.store.read(self.store_index)
+            except value_table.SlotBusy as e:
+                print('Battery level not readable from the store: %s' % e)
+                value, seq = None, 0
+            # Until the producer wrote a level, serve the simulated one
+            if seq and value:
+                return value
+
         print('Battery level read: ' + repr(self.battery_lvl))
         return [dbus.Byte(self.battery_lvl)]
 
@@ -731,7 +1492,7 @@ class BatteryLevelCharacteristic(Characteristic):
             return
 
         self.notifying = True
-        self.notify_battery_level()
+        self.notify_battery_level(force=True)
 
     def StopNotify(self):
         if not self.notifying:
@@ -794,12 +1555,8 @@ class TestDescriptor(Descriptor):
                 self, bus, index,
                 self.TEST_DESC_UUID,
                 ['read', 'write'],
-                characteristic)
-
-    def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+                characteristic,
+                value=b'Test')
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
     """
@@ -864,12 +1621,8 @@ class TestEncryptDescriptor(Descriptor):
                 self, bus, index,
                 self.TEST_DESC_UUID,
                 ['encrypt-read', 'encrypt-write'],
-                characteristic)
-
-    def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+                characteristic,
+                value=b'Test')
 
 class TestSecureCharacteristic(Characteristic):
     """
@@ -909,12 +1662,8 @@ class TestSecureDescriptor(Descriptor):
                 self, bus, index,
                 self.TEST_DESC_UUID,
                 ['secure-read', 'secure-write'],
-                characteristic)
-
-    def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+                characteristic,
+                value=b'Test')
 
 def register_app_cb():
     print('GATT application registered')
@@ -923,20 +1672,61 @@ def register_app_error_cb(mainloop, error):
     print('Failed to register application: ' + str(error))
     mainloop.quit()
 
-def gatt_server_main(mainloop, bus, adapter_name):
-    adapter = adapters.find_adapter(bus, GATT_MANAGER_IFACE, adapter_name)
-    if not adapter:
-        raise Exception('GattManager1 interface not found')
-
+def register_app(mainloop, bus, adapter, app=None):
     service_manager = dbus.Interface(
             bus.get_object(BLUEZ_SERVICE_NAME, adapter),
             GATT_MANAGER_IFACE)
 
-    app = Application(bus)
+    if app is None:
+        app = Application(bus)
 
-    print('Registering GATT application...')
+    print('Registering GATT application on %s...' % adapter)
+    app.registered = True
 
     service_manager.RegisterApplication(app.get_path(), {},
                                     reply_handler=register_app_cb,
                                     error_handler=functools.partial(register_app_error_cb, mainloop))
 
+    return app
+
+def adapter_ready_cb(mainloop, bus, adapter):
+    if not adapter:
+        print('GattManager1 interface not found')
+        mainloop.quit()
+        return
+
+    register_app(mainloop, bus, adapter)
+
+def gatt_server_main(mainloop, bus, adapter_name, wait_timeout=None):
+    if wait_timeout is not None:
+        adapters.wait_for_adapter(bus, GATT_MANAGER_IFACE, adapter_name,
+                                  functools.partial(adapter_ready_cb, mainloop, bus),
+                                  wait_timeout)
+        return
+
+    adapter = adapters.find_adapter(bus, GATT_MANAGER_IFACE, adapter_name)
+    if not adapter:
+        raise Exception('GattManager1 interface not found')
+
+    return register_app(mainloop, bus, adapter)
+
+def gatt_server_multi_main(mainloop, bus, adapter_names):
+    """
+    Register a single Application on several adapters. The service tree, and
+    with it characteristic state and notifications, is shared by all of them.
+    An empty adapter_names list selects every adapter with GattManager1.
+
+    """
+    adapter_paths = adapters.find_adapters(bus, GATT_MANAGER_IFACE,
+                                           adapter_names)
+    if not adapter_paths:
+        raise Exception('GattManager1 interface not found')
+
+    app = Application(bus)
+    for adapter in adapter_paths:
+        register_app(mainloop, bus, adapter, app)
+
+    stats = adapters.AdapterStats(adapters.get_registry(bus), adapter_paths)
+    observers.add_observer(stats)
+
+    return app, stats
@@ -5,6 +5,7 @@ import dbus.mainloop.glib
 import dbus.service
 
 import array
+import functools
 try:
   from gi.repository import GObject
 except ImportError:
@@ -12,6 +13,36 @@ except ImportError:
 import advertising_hid
 import gatt_server_hid
 import argparse
+import connection_params
+import data_sources
+import loop_monitor
+import supervisor
+import traffic_log
+import value_table
+
+
+def setup(args, adapter_name=None):
+    """
+    Apply the options configuring the process that serves the Application:
+    the single process, or each worker with --process-per-adapter. Workers
+    record to their own log, named after the adapter.
+
+    """
+    if args.loop_monitor is not None:
+        loop_monitor.start_monitor(args.loop_monitor)
+    if args.value_store:
+        value_table.open_store(args.value_store)
+    if args.battery_source:
+        data_sources.bind('battery_level', args.battery_source)
+    if args.record:
+        path = args.record
+        if adapter_name is not None:
+            path = '%s.%s' % (path, adapter_name)
+        traffic_log.start_recording(path)
+    if args.connection_profile:
+        connection_params.get_policy().set_profile(args.connection_profile)
+    if args.generic_access:
+        gatt_server_hid.Application.generic_access = True
 
 
 def main():
@@ -19,15 +50,61 @@ def main():
     print ("a", dbus.Byte(ord("a")))
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--adapter-name', type=str, help='Adapter name', default='')
+    parser.add_argument('-w', '--wait-adapter', type=float, default=None,
+                        help='Seconds to wait for the adapter to appear')
+    parser.add_argument('-m', '--multi-adapter', action='store_true',
+                        help='Serve on every adapter in the comma separated '
+                             '--adapter-name list (all adapters if empty)')
+    parser.add_argument('-p', '--process-per-adapter', action='store_true',
+                        help='Like --multi-adapter, but with one worker '
+                             'process per adapter')
+    parser.add_argument('-s', '--value-store', type=str, default=None,
+                        help='Memory-mapped file external producers publish '
+                             'characteristic values to')
+    parser.add_argument('-b', '--battery-source', type=str, default=None,
+                        help='File or sysfs attribute holding the battery '
+                             'level, e.g. /sys/class/power_supply/BAT0/capacity')
+    parser.add_argument('-r', '--record', type=str, default=None,
+                        help='Append the GATT traffic to this log (replay it '
+                             'with traffic_log.py)')
+    parser.add_argument('-l', '--loop-monitor', type=float, nargs='?',
+                        const=50, default=None, metavar='BUDGET_MS',
+                        help='Report main loop stalls and handlers longer '
+                             'than BUDGET_MS (default 50), and lag '
+                             'percentiles every minute')
+    parser.add_argument('-c', '--connection-profile', type=str, default=None,
+                        choices=sorted(connection_params.PROFILES),
+                        help='Preferred connection parameters for the whole '
+                             'application instead of the profiles of its '
+                             'services (served with --generic-access)')
+    parser.add_argument('-g', '--generic-access', action='store_true',
+                        help='Serve a GAP service with the Peripheral '
+                             'Preferred Connection Parameters')
     args = parser.parse_args()
     adapter_name = args.adapter_name
 
+    if args.process_per_adapter:
+        if args.wait_adapter is not None:
+            parser.error('--wait-adapter is not supported with '
+                         '--process-per-adapter')
+        adapter_names = [name for name in adapter_name.split(',') if name]
+        supervisor.supervisor_main(gatt_server_hid, advertising_hid, adapter_names,
+                                   functools.partial(setup, args))
+        return
+
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     bus = dbus.SystemBus()
     mainloop = GObject.MainLoop()
+    setup(args)
 
-    advertising_hid.advertising_main(mainloop, bus, adapter_name)
-    gatt_server_hid.gatt_server_main(mainloop, bus, adapter_name)
+    if args.multi_adapter:
+        adapter_names = [name for name in adapter_name.split(',') if name]
+        advertising_hid.advertising_multi_main(mainloop, bus, adapter_names)
+        app, stats = gatt_server_hid.gatt_server_multi_main(mainloop, bus, adapter_names)
+        GObject.timeout_add(10000, stats.print_report)
+    else:
+        advertising_hid.advertising_main(mainloop, bus, adapter_name, args.wait_adapter)
+        gatt_server_hid.gatt_server_main(mainloop, bus, adapter_name, args.wait_adapter)
     mainloop.run()
 
 if __name__ == '__main__':
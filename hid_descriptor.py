@@ -0,0 +1,310 @@
+"""
+HID report descriptor compiler.
+
+A ReportDescriptor is declared as a list of report descriptions (keyboard,
+consumer control, mouse, vendor) and compiled once into the bytes served by
+the HID Report Map characteristic.
+"""
+from __future__ import print_function
+
+# Item types
+MAIN = 0
+GLOBAL = 1
+LOCAL = 2
+
+# Main items
+INPUT = 0x8
+OUTPUT = 0x9
+FEATURE = 0xb
+COLLECTION = 0xa
+END_COLLECTION = 0xc
+
+# Global items
+USAGE_PAGE = 0x0
+LOGICAL_MINIMUM = 0x1
+LOGICAL_MAXIMUM = 0x2
+REPORT_SIZE = 0x7
+REPORT_ID = 0x8
+REPORT_COUNT = 0x9
+
+# Local items
+USAGE = 0x0
+USAGE_MINIMUM = 0x1
+USAGE_MAXIMUM = 0x2
+
+COLLECTION_PHYSICAL = 0x00
+COLLECTION_APPLICATION = 0x01
+
+DATA_ARRAY_ABS = 0x00
+CONSTANT = 0x01
+DATA_VAR_ABS = 0x02
+DATA_VAR_REL = 0x06
+
+# Report types, as used by the Report Reference descriptor
+REPORT_TYPE_INPUT = 0x01
+REPORT_TYPE_OUTPUT = 0x02
+REPORT_TYPE_FEATURE = 0x03
+
+_MAIN_REPORT_TYPES = {
+    INPUT: REPORT_TYPE_INPUT,
+    OUTPUT: REPORT_TYPE_OUTPUT,
+    FEATURE: REPORT_TYPE_FEATURE,
+}
+
+_SIGNED_ITEMS = ((GLOBAL, LOGICAL_MINIMUM), (GLOBAL, LOGICAL_MAXIMUM))
+
+
+class DescriptorError(Exception):
+    pass
+
+
+def item(tag, item_type, value=None, signed=False):
+    """
+    Encode one short item. value is stored in the smallest of 0, 1, 2 or 4
+    bytes that holds it.
+
+    """
+    if value is None:
+        return bytes([(tag << 4) | (item_type << 2)])
+
+    for size, size_code in ((1, 1), (2, 2), (4, 3)):
+        bits = 8 * size
+        if signed and -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+            break
+        if not signed and 0 <= value < (1 << bits):
+            break
+    else:
+        raise DescriptorError('item value out of range: %d' % value)
+
+    data = (value & ((1 << (8 * size)) - 1)).to_bytes(size, 'little')
+    return bytes([(tag << 4) | (item_type << 2) | size_code]) + data
+
+
+def usage_page(page):
+    return item(USAGE_PAGE, GLOBAL, page)
+
+def usage(value):
+    return item(USAGE, LOCAL, value)
+
+def usage_range(minimum, maximum):
+    return item(USAGE_MINIMUM, LOCAL, minimum) + \
+            item(USAGE_MAXIMUM, LOCAL, maximum)
+
+def logical_range(minimum, maximum):
+    return item(LOGICAL_MINIMUM, GLOBAL, minimum, signed=True) + \
+            item(LOGICAL_MAXIMUM, GLOBAL, maximum, signed=True)
+
+def report_format(size, count):
+    return item(REPORT_SIZE, GLOBAL, size) + item(REPORT_COUNT, GLOBAL, count)
+
+def collection(kind):
+    return item(COLLECTION, MAIN, kind)
+
+def end_collection():
+    return item(END_COLLECTION, MAIN)
+
+def report_id(value):
+    return item(REPORT_ID, GLOBAL, value)
+
+def main_input(flags):
+    return item(INPUT, MAIN, flags)
+
+def main_output(flags):
+    return item(OUTPUT, MAIN, flags)
+
+
+class Report(object):
+    """
+    Base class of the report descriptions. Subclasses implement items().
+
+    """
+    kind = None
+
+    def __init__(self, report_id):
+        if not 1 <= report_id <= 255:
+            raise DescriptorError('invalid report ID: %d' % report_id)
+        self.report_id = report_id
+
+    def items(self):
+        raise NotImplementedError()
+
+
+class KeyboardReport(Report):
+    """
+    Keyboard: modifiers, a reserved byte and 6 key codes as input, 5 LEDs as
+    output.
+
+    """
+    kind = 'keyboard'
+
+    def items(self):
+        return b''.join([
+            usage_page(0x01), usage(0x06), collection(COLLECTION_APPLICATION),
+            report_id(self.report_id),
+            usage_page(0x07), usage_range(0xe0, 0xe7), logical_range(0, 1),
+            report_format(1, 8), main_input(DATA_VAR_ABS),
+            report_format(8, 1), main_input(CONSTANT),
+            usage_page(0x08), usage_range(0x01, 0x05),
+            report_format(1, 5), main_output(DATA_VAR_ABS),
+            report_format(3, 1), main_output(CONSTANT),
+            usage_page(0x07), usage_range(0x00, 0x65), logical_range(0, 0x65),
+            report_format(8, 6), main_input(DATA_ARRAY_ABS),
+            end_collection(),
+        ])
+
+
+class ConsumerControlReport(Report):
+    """
+    Consumer control: one 16-bit consumer usage (volume, media keys...).
+
+    """
+    kind = 'consumer'
+
+    def items(self):
+        return b''.join([
+            usage_page(0x0c), usage(0x01), collection(COLLECTION_APPLICATION),
+            report_id(self.report_id),
+            usage_range(0x000, 0x3ff), logical_range(0x000, 0x3ff),
+            report_format(16, 1), main_input(DATA_ARRAY_ABS),
+            end_collection(),
+        ])
+
+
+class MouseReport(Report):
+    """
+    Mouse: 5 buttons, relative X and Y and wheel, one byte each.
+
+    """
+    kind = 'mouse'
+
+    def items(self):
+        return b''.join([
+            usage_page(0x01), usage(0x02), collection(COLLECTION_APPLICATION),
+            report_id(self.report_id),
+            usage(0x01), collection(COLLECTION_PHYSICAL),
+            usage_page(0x09), usage_range(0x01, 0x05), logical_range(0, 1),
+            report_format(1, 5), main_input(DATA_VAR_ABS),
+            report_format(3, 1), main_input(CONSTANT),
+            usage_page(0x01), usage(0x30), usage(0x31), usage(0x38),
+            logical_range(-127, 127), report_format(8, 3),
+            main_input(DATA_VAR_REL),
+            end_collection(),
+            end_collection(),
+        ])
+
+
+class VendorReport(Report):
+    """
+    Vendor defined input (and optionally output) report of size bytes.
+
+    """
+    kind = 'vendor'
+
+    def __init__(self, report_id, size, page=0xff00, output=False):
+        Report.__init__(self, report_id)
+        self.size = size
+        self.page = page
+        self.output = output
+
+    def items(self):
+        result = [
+            usage_page(self.page), usage(0x01),
+            collection(COLLECTION_APPLICATION),
+            report_id(self.report_id), logical_range(0, 255),
+            report_format(8, self.size), usage(0x01), main_input(DATA_VAR_ABS),
+        ]
+        if self.output:
+            result += [report_format(8, self.size), usage(0x01),
+                       main_output(DATA_VAR_ABS)]
+        result.append(end_collection())
+        return b''.join(result)
+
+
+def parse_items(data):
+    """
+    Yield (tag, type, value) for every short item of a descriptor.
+
+    """
+    i = 0
+    while i < len(data):
+        prefix = data[i]
+        if prefix == 0xfe:
+            raise DescriptorError('long items are not supported')
+        size = (0, 1, 2, 4)[prefix & 0x03]
+        if i + 1 + size > len(data):
+            raise DescriptorError('truncated item at offset %d' % i)
+        tag = prefix >> 4
+        item_type = (prefix >> 2) & 0x03
+        raw = data[i + 1:i + 1 + size]
+        signed = (item_type, tag) in _SIGNED_ITEMS
+        value = int.from_bytes(raw, 'little', signed=signed) if size else None
+        yield tag, item_type, value
+        i += 1 + size
+
+
+def report_sizes(data):
+    """
+    Walk a compiled descriptor and return {(report_id, report_type): bits}.
+    Raises DescriptorError on unbalanced collections or reports without ID.
+
+    """
+    sizes = {}
+    depth = 0
+    current_id = None
+    size = 0
+    count = 0
+    for tag, item_type, value in parse_items(data):
+        if item_type == GLOBAL:
+            if tag == REPORT_ID:
+                current_id = value
+            elif tag == REPORT_SIZE:
+                size = value
+            elif tag == REPORT_COUNT:
+                count = value
+        elif item_type == MAIN:
+            if tag == COLLECTION:
+                depth += 1
+            elif tag == END_COLLECTION:
+                depth -= 1
+                if depth < 0:
+                    raise DescriptorError('unbalanced End Collection')
+            elif tag in _MAIN_REPORT_TYPES:
+                if current_id is None:
+                    raise DescriptorError('report data before a Report ID')
+                key = (current_id, _MAIN_REPORT_TYPES[tag])
+                sizes[key] = sizes.get(key, 0) + size * count
+
+    if depth != 0:
+        raise DescriptorError('%d collections left open' % depth)
+    return sizes
+
+
+class ReportDescriptor(object):
+    """
+    Report descriptor compiled from report descriptions. The bytes are built
+    and validated once; the sizes of every (report ID, report type) are
+    available in report_bytes.
+
+    """
+    def __init__(self, reports):
+        self.reports = list(reports)
+        seen = set()
+        for report in self.reports:
+            if report.report_id in seen:
+                raise DescriptorError('duplicate report ID: %d' %
+                                      report.report_id)
+            seen.add(report.report_id)
+
+        self.data = b''.join(report.items() for report in self.reports)
+        self.report_bytes = {}
+        for key, bits in report_sizes(self.data).items():
+            if bits % 8:
+                raise DescriptorError('report %d type %d is not byte aligned' %
+                                      key)
+            self.report_bytes[key] = bits // 8
+
+    def report_size(self, report_id, report_type=REPORT_TYPE_INPUT):
+        return self.report_bytes.get((report_id, report_type), 0)
+
+
+DEFAULT_REPORTS = [KeyboardReport(1), ConsumerControlReport(2), MouseReport(3)]
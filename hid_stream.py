@@ -0,0 +1,428 @@
+from __future__ import print_function
+
+import collections
+import time
+
+import clock
+import keyboard_layouts
+
+
+REPORT_SIZE = keyboard_layouts.REPORT_SIZE
+
+
+class KeyReportPipeline(object):
+    """
+    Streams keyboard input reports through a characteristic at the rate of the
+    connection interval.
+
+    Key events (characters, or (modifier, usage) tuples) are encoded into a
+    ring of preallocated 8-byte report buffers, one press and one release
+    report per key. Text already encoded by a keyboard_layouts.Layout can be
+    streamed with feed_encoded(). Every interval milliseconds up to reports_per_tick reports
+    are handed to chrc.send_report(). The queue is bounded: push() refuses
+    keys when it is full, and sources given to feed() are only pulled while
+    there is room, one after the other in the order they were fed. While
+    chrc.is_streaming() is false the queue is not drained.
+
+    """
+    def __init__(self, chrc, interval=15, queue_size=64, reports_per_tick=1,
+                 layout=None, scheduler=None):
+        self.chrc = chrc
+        if scheduler is None:
+            scheduler = clock.get_scheduler()
+        self.scheduler = scheduler
+        self.interval = interval
+        self.reports_per_tick = reports_per_tick
+        if layout is None:
+            layout = keyboard_layouts.get_layout('us')
+        self.layout = layout
+        self.buffers = [bytearray(REPORT_SIZE) for i in range(queue_size)]
+        self.free = collections.deque(range(queue_size))
+        self.queue = collections.deque()
+        self.source = None
+        self.sources = collections.deque()
+        self.ready_cb = None
+        self.timer = None
+        self.reports_sent = 0
+        self.keys_sent = 0
+        self.keys_dropped = 0
+        self.started = None
+        self.busy_time = 0.0
+
+    def room(self):
+        """
+        Number of keys that can be queued right now.
+
+        """
+        return len(self.free) // 2
+
+    def _encode(self, modifier, usage):
+        index = self.free.popleft()
+        buf = self.buffers[index]
+        buf[0] = modifier
+        buf[2] = usage
+        self.queue.append(index)
+
+    def push(self, key):
+        """
+        Queue the press and release reports of key. Returns False, without
+        queueing anything, if the key is unknown or the queue is full.
+
+        """
+        if isinstance(key, tuple):
+            modifier, usage = key
+        else:
+            entry = self.layout.lookup(key)
+            if entry is None:
+                self.keys_dropped += 1
+                return False
+            modifier, usage = entry
+
+        if len(self.free) < 2:
+            return False
+
+        self._encode(modifier, usage)
+        self._encode(0, 0)
+        self._schedule()
+        return True
+
+    def feed(self, source):
+        """
+        Stream all key events of the iterable source, pulling from it as the
+        queue drains, after the sources fed before.
+
+        """
+        self.sources.append(iter(source))
+        self._refill()
+        self._schedule()
+
+    def feed_encoded(self, reports):
+        """
+        Stream a bytes object of consecutive 8-byte reports, such as the
+        output of Layout.encode().
+
+        """
+        view = memoryview(reports)
+        self.feed(view[i:i + REPORT_SIZE]
+                  for i in range(0, len(view), REPORT_SIZE))
+
+    def _push_report(self, report):
+        index = self.free.popleft()
+        self.buffers[index][:] = report
+        self.queue.append(index)
+
+    def on_ready(self, callback):
+        """
+        Call callback(room) whenever reports were sent and the queue has room
+        again, so that push-based producers can resume.
+
+        """
+        self.ready_cb = callback
+
+    def _refill(self):
+        while len(self.free) >= 2:
+            if self.source is None:
+                if not self.sources:
+                    break
+                self.source = self.sources.popleft()
+            try:
+                key = next(self.source)
+            except StopIteration:
+                self.source = None
+                continue
+            if isinstance(key, memoryview):
+                self._push_report(key)
+            else:
+                self.push(key)
+
+    def _schedule(self):
+        if self.timer is None and self.queue:
+            if self.started is None:
+                self.started = self.scheduler.now()
+            self.timer = self.scheduler.timeout_add(self.interval, self.tick)
+
+    def tick(self):
+        if not self.chrc.is_streaming():
+            self.timer = None
+            return False
+
+        for i in range(self.reports_per_tick):
+            if not self.queue:
+                break
+            index = self.queue.popleft()
+            buf = self.buffers[index]
+            self.chrc.send_report(buf)
+            if buf[2]:
+                self.keys_sent += 1
+            self.reports_sent += 1
+            self.free.append(index)
+
+        self._refill()
+        if self.ready_cb is not None and self.room():
+            self.ready_cb(self.room())
+
+        if not self.queue:
+            self.timer = None
+            self._idle()
+            return False
+        return True
+
+    def _idle(self):
+        # Only time spent streaming counts towards chars_per_second()
+        if self.started is not None:
+            self.busy_time += self.scheduler.now() - self.started
+            self.started = None
+
+    def resume(self):
+        """
+        Restart sending after the characteristic started notifying again.
+
+        """
+        self._schedule()
+
+    def drain(self):
+        """
+        Send everything queued and fed without pacing.
+
+        """
+        if self.timer is not None:
+            self.scheduler.source_remove(self.timer)
+            self.timer = None
+        if self.started is None:
+            self.started = self.scheduler.now()
+        while self.queue and self.tick():
+            pass
+        if not self.queue:
+            self._idle()
+
+    def chars_per_second(self):
+        elapsed = self.busy_time
+        if self.started is not None:
+            elapsed += self.scheduler.now() - self.started
+        if not elapsed or not self.keys_sent:
+            return 0.0
+        return self.keys_sent / elapsed
+
+
+def _saturate(value, limit=127):
+    if value > limit:
+        return limit
+    if value < -limit:
+        return -limit
+    return value
+
+
+class MotionCoalescer(object):
+    """
+    Merges relative mouse input into at most one report per flush.
+
+    move() accumulates X, Y and wheel deltas; flush() builds one report with
+    the deltas saturated to a signed byte and carries the remainder forward.
+    Button transitions are never merged away: each pending transition goes
+    out in its own report, in order.
+
+    The time from the oldest input merged into a report to the flush that
+    sent it is recorded in latencies (seconds).
+
+    """
+    def __init__(self, history=1024):
+        self.dx = 0
+        self.dy = 0
+        self.wheel = 0
+        self.buttons = 0
+        self.transitions = collections.deque()
+        self.pending_since = None
+        self.report = bytearray(4)
+        self.latencies = collections.deque(maxlen=history)
+        self.inputs = 0
+        self.reports = 0
+
+    def pending(self):
+        return bool(self.dx or self.dy or self.wheel or self.transitions)
+
+    def move(self, dx, dy, wheel=0, now=None):
+        self.dx += dx
+        self.dy += dy
+        self.wheel += wheel
+        self.inputs += 1
+        if self.pending_since is None:
+            self.pending_since = time.monotonic() if now is None else now
+
+    def set_buttons(self, buttons, now=None):
+        last = self.transitions[-1] if self.transitions else self.buttons
+        if buttons == last:
+            return
+        self.transitions.append(buttons)
+        self.inputs += 1
+        if self.pending_since is None:
+            self.pending_since = time.monotonic() if now is None else now
+
+    def flush(self, now=None):
+        """
+        Return the next report, or None if nothing is pending.
+
+        """
+        if not self.pending():
+            return None
+
+        if self.transitions:
+            self.buttons = self.transitions.popleft()
+
+        dx = _saturate(self.dx)
+        dy = _saturate(self.dy)
+        wheel = _saturate(self.wheel)
+        self.dx -= dx
+        self.dy -= dy
+        self.wheel -= wheel
+
+        report = self.report
+        report[0] = self.buttons
+        report[1] = dx & 0xff
+        report[2] = dy & 0xff
+        report[3] = wheel & 0xff
+
+        if now is None:
+            now = time.monotonic()
+        self.latencies.append(now - self.pending_since)
+        self.pending_since = now if self.pending() else None
+        self.reports += 1
+        return report
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        values = sorted(self.latencies)
+        if not values:
+            return {}
+        return dict((p, values[min(len(values) - 1, len(values) * p // 100)])
+                    for p in percentiles)
+
+
+LED_NAMES = ('num_lock', 'caps_lock', 'scroll_lock', 'compose', 'kana')
+
+
+class LedState(object):
+    """
+    Keyboard LED state from output reports. update() decodes the LED bitmap
+    and calls every callback(leds, changed) right away, leds and changed being
+    dicts of LED name -> state, the latter holding only the LEDs that changed.
+
+    """
+    def __init__(self):
+        self.bitmap = 0
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def leds(self, bitmap=None):
+        if bitmap is None:
+            bitmap = self.bitmap
+        return dict((name, bool(bitmap & (1 << bit)))
+                    for bit, name in enumerate(LED_NAMES))
+
+    def update(self, data):
+        if not data:
+            return
+        bitmap = data[0]
+        diff = bitmap ^ self.bitmap
+        self.bitmap = bitmap
+        if not diff:
+            return
+
+        leds = self.leds(bitmap)
+        changed = dict((name, leds[name])
+                       for bit, name in enumerate(LED_NAMES) if diff & (1 << bit))
+        for callback in list(self.callbacks):
+            callback(leds, changed)
+
+
+def benchmark(text=None, repeat=200):
+    """
+    Measure the encoding and emission throughput of the pipeline against a
+    LocalBus, without pacing.
+
+    """
+    import local_bus
+    import gatt_server_hid
+
+    if text is None:
+        text = 'The quick brown fox jumps over the lazy dog. 0123456789\n'
+
+    bus = local_bus.LocalBus()
+    service = gatt_server_hid.HidService(bus, 0)
+    chrc = service.report_characteristic
+    chrc.notifying = True
+
+    pipeline = chrc.pipeline
+    service.type_text(text * repeat)
+    pipeline.drain()
+
+    print('%d characters, %d reports, %d signals: %.0f characters/s' %
+          (pipeline.keys_sent, pipeline.reports_sent, bus.signals_sent,
+           pipeline.chars_per_second()))
+    return pipeline.chars_per_second()
+
+
+def benchmark_mouse(seconds=10, input_rate=1000):
+    """
+    Feed input_rate motion events per second for seconds of virtual time to
+    the mouse report characteristic of a HidService on a LocalBus, and report
+    the latency from move() to the PropertiesChanged signal carrying it.
+
+    """
+    import local_bus
+    import gatt_server_hid
+
+    scheduler = clock.VirtualScheduler()
+    clock.set_scheduler(scheduler)
+    try:
+        bus = local_bus.LocalBus()
+        service = gatt_server_hid.HidService(bus, 0)
+        chrc = service.mouse_characteristic
+        chrc.notifying = True
+
+        # Times of the moves not sent yet; a report carries all of them
+        moves = collections.deque()
+        latencies = []
+
+        def signal_sent(path, interface, member, args):
+            if str(path) != chrc.path or 'Value' not in args[1]:
+                return
+            if moves:
+                latencies.append(scheduler.now() - moves[0])
+                moves.clear()
+
+        def move():
+            moves.append(scheduler.now())
+            chrc.move(3, -2)
+            return True
+
+        bus.add_signal_listener(signal_sent)
+        timer = scheduler.timeout_add(1000.0 / input_rate, move)
+        start = time.perf_counter()
+        scheduler.advance(seconds)
+        scheduler.source_remove(timer)
+        scheduler.run()
+        elapsed = time.perf_counter() - start
+    finally:
+        clock.set_scheduler(clock.RealScheduler())
+
+    latencies.sort()
+    percentiles = dict(
+            (p, latencies[min(len(latencies) - 1, len(latencies) * p // 100)])
+            for p in (50, 90, 99))
+    print('%d inputs -> %d reports, %d signals, latency p50 %.2f ms, '
+          'p90 %.2f ms, p99 %.2f ms, %.2f us CPU per input' %
+          (chrc.coalescer.inputs, chrc.coalescer.reports, bus.signals_sent,
+           percentiles[50] * 1000, percentiles[90] * 1000,
+           percentiles[99] * 1000,
+           elapsed / max(1, chrc.coalescer.inputs) * 1e6))
+    return percentiles
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark_mouse()
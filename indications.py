@@ -0,0 +1,173 @@
+from __future__ import print_function
+import collections
+
+import clock
+
+
+class IndicationQueue(object):
+    """
+    Paces the indications of one characteristic.
+
+    ATT allows a single unconfirmed indication per connection, so values are
+    queued and handed to send(value) one at a time: the next one goes out as
+    soon as BlueZ calls Confirm for the previous one, which keeps the link as
+    busy as the central's confirmations allow. An indication not confirmed
+    within timeout milliseconds is sent again, up to retries times, then
+    dropped. When the queue holds size values the oldest is dropped.
+
+    BlueZ indicates every subscribed central and calls Confirm once per
+    central, without saying which. subscribers() returns the connected
+    centrals an indication may go to; the first value after they changed
+    waits for a confirm from each. If only some of them confirmed when the
+    timeout expires, the value is not sent again (it would reach the others
+    too), the missing confirms count as unconfirmed and the number that did
+    confirm is used for the following values, so that connected centrals
+    that did not subscribe cost a single timeout. A confirm arriving when
+    none is awaited counts as a duplicate and raises that number again, up
+    to the number of connected centrals.
+
+    Round-trip times from send to each Confirm are kept in latencies
+    (seconds).
+
+    """
+    def __init__(self, send, timeout=1000, retries=2, size=32, history=1024,
+                 scheduler=None, subscribers=None):
+        self.send = send
+        self.subscribers = subscribers
+        if scheduler is None:
+            scheduler = clock.get_scheduler()
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.retries = retries
+        # One slot holds the value waiting for its Confirm
+        if size < 2:
+            raise ValueError('indication queue size must be at least 2')
+        self.queue = collections.deque(maxlen=size)
+        self.outstanding = False
+        self.centrals = None
+        self.confirmers = None
+        self.awaiting = 0
+        self.sent_to = 0
+        self.sent_at = None
+        self.attempts = 0
+        self.timer = None
+        self.latencies = collections.deque(maxlen=history)
+        self.sent = 0
+        self.confirmed = 0
+        self.timeouts = 0
+        self.dropped = 0
+        self.unconfirmed = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, value):
+        if len(self.queue) == self.queue.maxlen:
+            # Never drop the value waiting for its Confirm
+            if self.outstanding:
+                head = self.queue.popleft()
+                self.queue.popleft()
+                self.queue.appendleft(head)
+            else:
+                self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(value)
+        if not self.outstanding:
+            self._send_next()
+
+    def _send_next(self):
+        if not self.queue:
+            self.outstanding = False
+            return
+
+        self.outstanding = True
+        self.attempts += 1
+        if self.attempts == 1:
+            self.sent_to = self._expected_confirms()
+            self.awaiting = self.sent_to
+        self.sent += 1
+        self.sent_at = self.scheduler.now()
+        self.timer = self.scheduler.timeout_add(self.timeout, self._timed_out)
+        self.send(self.queue[0])
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.scheduler.source_remove(self.timer)
+            self.timer = None
+
+    def _expected_confirms(self):
+        centrals = len(self.subscribers()) if self.subscribers else 0
+        if centrals != self.centrals:
+            # Other centrals now; find out again which of them confirm
+            self.centrals = centrals
+            self.confirmers = None
+        if self.confirmers is None:
+            return max(centrals, 1)
+        return max(min(self.confirmers, centrals), 1)
+
+    def confirm(self):
+        """
+        Confirm received for the outstanding indication.
+
+        """
+        if not self.outstanding or not self.awaiting:
+            self.duplicates += 1
+            if self.confirmers is not None:
+                self.confirmers += 1
+            return
+
+        self.awaiting -= 1
+        self.latencies.append(self.scheduler.now() - self.sent_at)
+        if not self.awaiting:
+            self.confirmed += 1
+            self._complete()
+
+    def _complete(self):
+        self._cancel_timer()
+        self.queue.popleft()
+        self.attempts = 0
+        self.awaiting = 0
+        self._send_next()
+
+    def _timed_out(self):
+        self.timer = None
+        self.timeouts += 1
+        if self.awaiting < self.sent_to:
+            # Sending again would indicate the centrals that confirmed too
+            print('Indication not confirmed by %d of %d centrals' %
+                  (self.awaiting, self.sent_to))
+            self.unconfirmed += self.awaiting
+            self.confirmers = self.sent_to - self.awaiting
+            self._complete()
+            return False
+        if self.attempts > self.retries:
+            print('Indication not confirmed after %d attempts, dropped' %
+                  self.attempts)
+            self.queue.popleft()
+            self.dropped += 1
+            self.attempts = 0
+            self.awaiting = 0
+        self._send_next()
+        return False
+
+    def clear(self):
+        self._cancel_timer()
+        self.queue.clear()
+        self.outstanding = False
+        self.awaiting = 0
+        self.attempts = 0
+        self.confirmers = None
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        values = sorted(self.latencies)
+        if not values:
+            return {}
+        return dict((p, values[min(len(values) - 1, len(values) * p // 100)])
+                    for p in percentiles)
+
+    def stats(self):
+        return {'sent': self.sent, 'confirmed': self.confirmed,
+                'timeouts': self.timeouts, 'dropped': self.dropped,
+                'unconfirmed': self.unconfirmed,
+                'duplicates': self.duplicates, 'queued': len(self.queue)}
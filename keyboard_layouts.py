@@ -0,0 +1,180 @@
+from __future__ import print_function
+import array
+
+
+MODIFIER_LEFT_SHIFT = 0x02
+MODIFIER_RIGHT_ALT = 0x40
+
+REPORT_SIZE = 8
+# Press and release report of one character
+CHAR_REPORTS_SIZE = 2 * REPORT_SIZE
+
+TABLE_SIZE = 256
+
+
+class Layout(object):
+    """
+    Keyboard layout: lookup tables from characters to HID (modifier, usage
+    code) pairs.
+
+    Characters up to U+00FF are looked up by index in two byte tables, which
+    also serve as bytes.translate() tables so that encode() turns a whole
+    string into reports without a Python loop per character. The encoded
+    press/release reports of every mapped character are cached as well.
+
+    """
+    def __init__(self, name, keys):
+        self.name = name
+        self.keys = dict(keys)
+        self.modifiers = array.array('B', bytes(TABLE_SIZE))
+        self.usages = array.array('B', bytes(TABLE_SIZE))
+        self.reports = [None] * TABLE_SIZE
+        self.wide_reports = {}
+
+        for char, (modifier, usage) in self.keys.items():
+            report = bytearray(CHAR_REPORTS_SIZE)
+            report[0] = modifier
+            report[2] = usage
+            code = ord(char)
+            if code < TABLE_SIZE:
+                self.modifiers[code] = modifier
+                self.usages[code] = usage
+                self.reports[code] = bytes(report)
+            else:
+                self.wide_reports[char] = bytes(report)
+
+        self.modifier_table = self.modifiers.tobytes()
+        self.usage_table = self.usages.tobytes()
+
+    def lookup(self, char):
+        """
+        Return the (modifier, usage) pair of char, or None if the layout
+        cannot type it.
+
+        """
+        return self.keys.get(char)
+
+    def char_reports(self, char):
+        """
+        Return the cached press and release reports of char, or None.
+
+        """
+        code = ord(char)
+        if code < TABLE_SIZE:
+            return self.reports[code]
+        return self.wide_reports.get(char)
+
+    def encode(self, text):
+        """
+        Return the press and release reports of every character of text as one
+        bytes object. Raises ValueError if a character cannot be typed.
+
+        """
+        try:
+            raw = text.encode('latin-1')
+        except UnicodeEncodeError:
+            return self._encode_slow(text)
+
+        usages = raw.translate(self.usage_table)
+        missing = usages.find(b'\0')
+        if missing >= 0:
+            raise ValueError('%r cannot be typed with the %s layout' %
+                             (text[missing], self.name))
+
+        out = bytearray(CHAR_REPORTS_SIZE * len(raw))
+        out[0::CHAR_REPORTS_SIZE] = raw.translate(self.modifier_table)
+        out[2::CHAR_REPORTS_SIZE] = usages
+        return bytes(out)
+
+    def _encode_slow(self, text):
+        out = []
+        for char in text:
+            reports = self.char_reports(char)
+            if reports is None:
+                raise ValueError('%r cannot be typed with the %s layout' %
+                                 (char, self.name))
+            out.append(reports)
+        return b''.join(out)
+
+
+def _us_keys():
+    keys = {'\n': (0, 0x28), '\t': (0, 0x2b), ' ': (0, 0x2c),
+            '\b': (0, 0x2a), '\x1b': (0, 0x29)}
+    for i, c in enumerate('abcdefghijklmnopqrstuvwxyz'):
+        keys[c] = (0, 0x04 + i)
+        keys[c.upper()] = (MODIFIER_LEFT_SHIFT, 0x04 + i)
+    for i, c in enumerate('1234567890'):
+        keys[c] = (0, 0x1e + i)
+    for i, c in enumerate('!@#$%^&*()'):
+        keys[c] = (MODIFIER_LEFT_SHIFT, 0x1e + i)
+    for plain, usage, shifted in [('-', 0x2d, '_'), ('=', 0x2e, '+'),
+                                  ('[', 0x2f, '{'), (']', 0x30, '}'),
+                                  ('\\', 0x31, '|'), (';', 0x33, ':'),
+                                  ("'", 0x34, '"'), ('`', 0x35, '~'),
+                                  (',', 0x36, '<'), ('.', 0x37, '>'),
+                                  ('/', 0x38, '?')]:
+        keys[plain] = (0, usage)
+        keys[shifted] = (MODIFIER_LEFT_SHIFT, usage)
+    return keys
+
+
+US_KEYS = _us_keys()
+
+UK_KEYS = dict(US_KEYS)
+UK_KEYS.update({
+    '"': (MODIFIER_LEFT_SHIFT, 0x1f),
+    '\xa3': (MODIFIER_LEFT_SHIFT, 0x20),
+    '@': (MODIFIER_LEFT_SHIFT, 0x34),
+    '#': (0, 0x32),
+    '~': (MODIFIER_LEFT_SHIFT, 0x32),
+    '\\': (0, 0x64),
+    '|': (MODIFIER_LEFT_SHIFT, 0x64),
+    '\xac': (MODIFIER_LEFT_SHIFT, 0x35),
+})
+
+DE_KEYS = dict(US_KEYS)
+DE_KEYS.update({
+    'y': (0, 0x1d), 'Y': (MODIFIER_LEFT_SHIFT, 0x1d),
+    'z': (0, 0x1c), 'Z': (MODIFIER_LEFT_SHIFT, 0x1c),
+    '\xe4': (0, 0x34), '\xc4': (MODIFIER_LEFT_SHIFT, 0x34),
+    '\xf6': (0, 0x33), '\xd6': (MODIFIER_LEFT_SHIFT, 0x33),
+    '\xfc': (0, 0x2f), '\xdc': (MODIFIER_LEFT_SHIFT, 0x2f),
+    '\xdf': (0, 0x2d), '?': (MODIFIER_LEFT_SHIFT, 0x2d),
+    '"': (MODIFIER_LEFT_SHIFT, 0x1f), '\xa7': (MODIFIER_LEFT_SHIFT, 0x20),
+    '&': (MODIFIER_LEFT_SHIFT, 0x23), '/': (MODIFIER_LEFT_SHIFT, 0x24),
+    '(': (MODIFIER_LEFT_SHIFT, 0x25), ')': (MODIFIER_LEFT_SHIFT, 0x26),
+    '=': (MODIFIER_LEFT_SHIFT, 0x27), '+': (0, 0x30),
+    '*': (MODIFIER_LEFT_SHIFT, 0x30), '#': (0, 0x32),
+    "'": (MODIFIER_LEFT_SHIFT, 0x32), '-': (0, 0x38),
+    '_': (MODIFIER_LEFT_SHIFT, 0x38), ',': (0, 0x36),
+    ';': (MODIFIER_LEFT_SHIFT, 0x36), '.': (0, 0x37),
+    ':': (MODIFIER_LEFT_SHIFT, 0x37), '<': (0, 0x64),
+    '>': (MODIFIER_LEFT_SHIFT, 0x64), '@': (MODIFIER_RIGHT_ALT, 0x14),
+    '\u20ac': (MODIFIER_RIGHT_ALT, 0x08),
+})
+for _char in '[]{}\\|`~^':
+    DE_KEYS.pop(_char, None)
+
+_layouts = {}
+
+
+def register_layout(name, keys):
+    """
+    Build and register a layout from a character -> (modifier, usage) dict.
+
+    """
+    layout = Layout(name, keys)
+    _layouts[name] = layout
+    return layout
+
+
+def get_layout(name):
+    layout = _layouts.get(name)
+    if layout is None:
+        raise KeyError('unknown keyboard layout: %s' % name)
+    return layout
+
+
+register_layout('us', US_KEYS)
+register_layout('uk', UK_KEYS)
+register_layout('de', DE_KEYS)
@@ -0,0 +1,310 @@
+"""
+Load generator impersonating bluetoothd and its centrals on a LocalBus.
+
+The service tree of an Application is discovered like bluetoothd does, with
+GetManagedObjects. N simulated centrals then connect and issue a random mix
+of reads (continued with offsets while the value fills the MTU), writes and
+subscription changes at a given rate, each with its own MTU. Indications are
+confirmed as they arrive.
+
+The run is driven in real time by a single loop. Timers of the server run on
+a VirtualScheduler that the loop keeps up with the real clock, so a timer
+fires late when the server is busy: the notification delivery lag is the
+time from a timer's deadline to the notification it emitted.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import heapq
+import importlib
+import os
+import random
+import time
+
+import clock
+
+
+GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+
+OPERATIONS = ('read', 'write', 'subscribe')
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    values = sorted(values)
+    if not values:
+        return dict((p, 0.0) for p in points)
+    return dict((p, values[min(len(values) - 1, int(len(values) * p / 100))])
+                for p in points)
+
+
+def rss_kib():
+    """
+    Resident set size of this process in KiB (Linux), or 0.
+
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class Central(object):
+    def __init__(self, index, mtu):
+        self.device = '/org/bluez/hci0/dev_00_00_00_00_%02X_%02X' % (
+                index >> 8, index & 0xff)
+        self.mtu = mtu
+        self.subscriptions = set()
+
+    def options(self, offset=0):
+        options = {'device': self.device, 'mtu': self.mtu, 'link': 'LE'}
+        if offset:
+            options['offset'] = offset
+        return options
+
+
+class LoadGenerator(object):
+    """
+    Runs simulated centrals (as many as centrals) against the Application
+    of module_name on a LocalBus. mix weighs the operations, mtus are picked
+    from at random per central, rate is the operations per second of each
+    central.
+
+    """
+    def __init__(self, module_name='gatt_server', centrals=50, rate=10,
+                 mix=None, mtus=(23, 185, 247), seed=0):
+        import dbus
+        import dbus.exceptions
+        import adapters
+        import local_bus
+
+        self.dbus = dbus
+        self.random = random.Random(seed)
+        self.scheduler = clock.VirtualScheduler(seed)
+        clock.set_scheduler(self.scheduler)
+
+        module = importlib.import_module(module_name)
+        self.bus = local_bus.LocalBus()
+        self.app = module.Application(self.bus)
+        self.bus.add_signal_listener(self._signal)
+
+        self.readable = []
+        self.writable = []
+        self.notifiable = []
+        for path, interfaces in self.app.GetManagedObjects().items():
+            props = interfaces.get(GATT_CHRC_IFACE)
+            if props is None:
+                continue
+            chrc = self.bus.get_local_object(str(path))
+            flags = [str(flag) for flag in props['Flags']]
+            if any(flag.endswith('read') for flag in flags):
+                self.readable.append(chrc)
+            if any(flag.startswith('write') or flag.endswith('-write')
+                   for flag in flags):
+                self.writable.append(chrc)
+            if 'notify' in flags or 'indicate' in flags:
+                self.notifiable.append(chrc)
+
+        self.rate = rate
+        weights = dict(read=6, write=2, subscribe=2)
+        if mix:
+            weights = dict(mix)
+        self.operations = [op for op in OPERATIONS if weights.get(op)]
+        self.weights = [weights[op] for op in self.operations]
+
+        self.centrals = []
+        for i in range(centrals):
+            central = Central(i, self.random.choice(mtus))
+            self.centrals.append(central)
+            self.bus.emit_remote_signal(
+                    central.device, module.DBUS_PROP_IFACE,
+                    'PropertiesChanged', adapters.DEVICE_IFACE,
+                    {'Connected': True}, [])
+
+        self.subscribers = collections.defaultdict(int)
+        self.last_values = {}
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.notifications = 0
+        self.deliveries = 0
+        self.lags = []
+        self.memory = []
+        self.start = None
+
+    def _signal(self, path, interface, member, args):
+        if member != 'PropertiesChanged' or 'Value' not in args[1]:
+            return
+
+        self.notifications += 1
+        self.deliveries += self.subscribers.get(path, 0)
+        if self.start is not None:
+            self.lags.append(time.perf_counter() - self.start -
+                             self.scheduler.now())
+
+        # bluetoothd confirms once per subscribed central
+        chrc = self.bus.get_local_object(path)
+        if chrc is not None and 'indicate' in chrc.flags:
+            for i in range(self.subscribers.get(path, 0)):
+                chrc.Confirm()
+
+    def _call(self, operation, handler, *args):
+        start = time.perf_counter()
+        try:
+            result = handler(*args)
+        except self.dbus.exceptions.DBusException as e:
+            self.errors[(operation, e.get_dbus_name())] += 1
+            result = None
+        self.latencies[operation].append(time.perf_counter() - start)
+        return result
+
+    def read(self, central):
+        if not self.readable:
+            return
+        chrc = self.random.choice(self.readable)
+        offset = 0
+        value = b''
+        # bluetoothd sends what fits in the MTU, and the central continues
+        # long values with Read Blob requests
+        while True:
+            part = self._call('read', chrc.ReadValue, central.options(offset))
+            if part is None:
+                return
+            part = bytes(bytearray(part))[:central.mtu - 1]
+            value += part
+            offset += len(part)
+            if len(part) < central.mtu - 1 or offset >= 512:
+                break
+        self.last_values[chrc.path] = value
+
+    def write(self, central):
+        if not self.writable:
+            return
+        chrc = self.random.choice(self.writable)
+        value = self.last_values.get(chrc.path) or b'\x01'
+        value = value[:central.mtu - 3]
+        self._call('write', chrc.WriteValue,
+                   self.dbus.Array([self.dbus.Byte(b) for b in value],
+                                   signature='y'),
+                   central.options())
+
+    def subscribe(self, central):
+        if not self.notifiable:
+            return
+        chrc = self.random.choice(self.notifiable)
+        path = chrc.path
+        # bluetoothd only calls StartNotify for the first subscriber and
+        # StopNotify for the last one
+        if path in central.subscriptions:
+            central.subscriptions.discard(path)
+            self.subscribers[path] -= 1
+            if not self.subscribers[path]:
+                self._call('subscribe', chrc.StopNotify)
+        else:
+            central.subscriptions.add(path)
+            self.subscribers[path] += 1
+            if self.subscribers[path] == 1:
+                self._call('subscribe', chrc.StartNotify)
+
+    def run(self, seconds=10, report_interval=1.0):
+        events = []
+        for i, central in enumerate(self.centrals):
+            heapq.heappush(events, (self.random.expovariate(self.rate), i))
+
+        self.start = time.perf_counter()
+        next_report = report_interval
+        operations = 0
+        while True:
+            now = time.perf_counter() - self.start
+            if now >= seconds:
+                break
+
+            # Server timers due by now, late if the loop fell behind
+            self.scheduler.run(now)
+
+            if now >= next_report:
+                self.memory.append((now, rss_kib()))
+                print('%5.1f s: %d operations, %d notifications, RSS %d KiB' %
+                      (now, operations, self.notifications,
+                       self.memory[-1][1]))
+                next_report += report_interval
+
+            due, i = events[0]
+            if due > now:
+                time.sleep(min(due - now, 0.001))
+                continue
+
+            heapq.heapreplace(events, (due + self.random.expovariate(self.rate),
+                                       i))
+            operation = self.random.choices(self.operations, self.weights)[0]
+            getattr(self, operation)(self.centrals[i])
+            operations += 1
+
+        elapsed = time.perf_counter() - self.start
+        clock.set_scheduler(clock.RealScheduler())
+        return self.report(operations, elapsed)
+
+    def report(self, operations, elapsed):
+        result = {
+            'operations': operations,
+            'throughput': operations / elapsed,
+            'notifications': self.notifications,
+            'deliveries': self.deliveries,
+            'errors': dict(self.errors),
+            'latency': dict((op, percentiles(values))
+                            for op, values in self.latencies.items()),
+            'lag': percentiles(self.lags),
+            'memory': self.memory,
+        }
+
+        print('%d centrals: %d operations in %.1f s (%.0f/s), %d notifications '
+              '(%d deliveries)' %
+              (len(self.centrals), operations, elapsed, result['throughput'],
+               self.notifications, self.deliveries))
+        for op, values in sorted(result['latency'].items()):
+            print('  %-9s p50 %.3f ms, p99 %.3f ms, p99.9 %.3f ms' %
+                  (op, values[50] * 1000, values[99] * 1000,
+                   values[99.9] * 1000))
+        print('  notification lag p50 %.3f ms, p99 %.3f ms' %
+              (result['lag'][50] * 1000, result['lag'][99] * 1000))
+        for (op, name), count in sorted(self.errors.items()):
+            print('  %d %s errors: %s' % (count, op, name))
+        return result
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('unknown operation: %s' % name)
+        mix[name] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Stress a GATT server with simulated centrals')
+    parser.add_argument('-m', '--module', default='gatt_server',
+                        help='Module of the Application to load')
+    parser.add_argument('-n', '--centrals', type=int, default=50)
+    parser.add_argument('-r', '--rate', type=float, default=10,
+                        help='Operations per second of each central')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='Seconds to run for')
+    parser.add_argument('-x', '--mix', type=parse_mix, default=None,
+                        help='Operation weights, e.g. read=6,write=2,'
+                             'subscribe=2')
+    parser.add_argument('-u', '--mtu', type=str, default='23,185,247',
+                        help='Comma separated MTUs the centrals pick from')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mtus = [int(mtu) for mtu in args.mtu.split(',')]
+    generator = LoadGenerator(args.module, args.centrals, args.rate, args.mix,
+                              mtus, args.seed)
+    generator.run(args.duration)
+
+
+if __name__ == '__main__':
+    main()
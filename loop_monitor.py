@@ -0,0 +1,134 @@
+"""
+Main loop lag monitor and slow handler watchdog.
+
+A heartbeat timer measures how late the GLib main loop dispatches it: the
+dispatch lag every other source (notification timers, D-Bus calls) suffers
+too. A watchdog thread notices when the heartbeat stops for longer than the
+budget, i.e. the loop is blocked, and samples the stack of the main thread
+while it is. As an observer, the monitor also flags GATT handlers that ran
+longer than the budget, with the stack sampled during their stall.
+"""
+from __future__ import print_function
+import collections
+import sys
+import threading
+import time
+import traceback
+
+try:
+  from gi.repository import GObject
+except ImportError:
+  import gobject as GObject
+
+import observers
+
+
+class LoopMonitor(object):
+    """
+    Heartbeat every interval milliseconds; stalls and handlers longer than
+    budget milliseconds are reported.
+
+    """
+    def __init__(self, interval=10, budget=50, history=4096):
+        self.interval = interval
+        self.budget = budget / 1000.0
+        self.lags = collections.deque(maxlen=history)
+        self.slow_handlers = collections.Counter()
+        self.stalls = 0
+        self.stall_stack = None
+        self.main_thread = threading.current_thread().ident
+        self.expected = None
+        self.last_beat = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.last_beat = time.perf_counter()
+        self.expected = self.last_beat + self.interval / 1000.0
+        GObject.timeout_add(self.interval, self._beat)
+        observers.add_observer(self)
+        watchdog = threading.Thread(target=self._watch, name='loop-watchdog')
+        watchdog.daemon = True
+        watchdog.start()
+
+    def stop(self):
+        self.running = False
+        observers.remove_observer(self)
+
+    def _beat(self):
+        now = time.perf_counter()
+        self.lags.append(max(0.0, now - self.expected))
+        self.last_beat = now
+        self.expected = now + self.interval / 1000.0
+        return self.running
+
+    def _watch(self):
+        stalled = False
+        while self.running:
+            time.sleep(self.budget / 2)
+            blocked = time.perf_counter() - self.last_beat - \
+                    self.interval / 1000.0
+            if blocked <= self.budget:
+                stalled = False
+                continue
+            if stalled:
+                continue
+
+            # Report every stall once, with the code the loop is stuck in
+            stalled = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self.main_thread)
+            if frame is None:
+                continue
+            self.stall_stack = ''.join(traceback.format_stack(frame))
+            print('Main loop blocked for %.0f ms in:\n%s' %
+                  (blocked * 1000, self.stall_stack))
+
+    def __call__(self, obj, name, args, elapsed, error):
+        if elapsed <= self.budget:
+            return
+
+        path = getattr(obj, 'path', '?')
+        self.slow_handlers[(path, name)] += 1
+        print('Slow handler: %s.%s took %.1f ms (budget %.0f ms)' %
+              (path, name, elapsed * 1000, self.budget * 1000))
+        if self.stall_stack is not None:
+            print('Stack sampled while it ran:\n%s' % self.stall_stack)
+            self.stall_stack = None
+
+    def percentiles(self, points=(50, 90, 99, 99.9)):
+        values = sorted(self.lags)
+        if not values:
+            return {}
+        return dict((p, values[min(len(values) - 1, int(len(values) * p / 100))])
+                    for p in points)
+
+    def report(self):
+        return {
+            'lag': self.percentiles(),
+            'max_lag': max(self.lags) if self.lags else 0.0,
+            'stalls': self.stalls,
+            'slow_handlers': dict(self.slow_handlers),
+        }
+
+    def print_report(self):
+        lag = self.percentiles()
+        if lag:
+            print('Main loop lag p50 %.2f ms, p99 %.2f ms, p99.9 %.2f ms, '
+                  'max %.2f ms; %d stalls, %d slow handler calls' %
+                  (lag[50] * 1000, lag[99] * 1000, lag[99.9] * 1000,
+                   max(self.lags) * 1000, self.stalls,
+                   sum(self.slow_handlers.values())))
+        return True
+
+
+def start_monitor(budget=50, report_interval=60000):
+    """
+    Start a LoopMonitor and print its report every report_interval
+    milliseconds.
+
+    """
+    monitor = LoopMonitor(budget=budget)
+    monitor.start()
+    GObject.timeout_add(report_interval, monitor.print_report)
+    return monitor
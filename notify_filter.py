@@ -0,0 +1,89 @@
+from __future__ import print_function
+
+import clock
+
+
+def decode_unsigned(value):
+    """
+    Value of a little-endian unsigned integer characteristic.
+
+    """
+    return int.from_bytes(bytes(bytearray(value)), 'little')
+
+
+class NotifyFilter(object):
+    """
+    Decides which value updates are worth a notification.
+
+    An update is suppressed if it is identical to the last value notified,
+    or if it is within the deadband of it: deadband is absolute, relative a
+    fraction of the last value, both compared on decode(value). Once
+    max_quiet seconds passed since the last notification the next update
+    goes out regardless, as a heartbeat.
+
+    """
+    def __init__(self, deadband=0, relative=0, max_quiet=None,
+                 decode=decode_unsigned):
+        self.deadband = deadband
+        self.relative = relative
+        self.max_quiet = max_quiet
+        self.decode = decode
+        self.last_value = None
+        self.last_number = None
+        self.last_sent = None
+        self.sent = 0
+        self.suppressed = 0
+        self.heartbeats = 0
+
+    def reset(self):
+        """
+        Forget the last value, so that the next update is sent (e.g. to a new
+        subscriber).
+
+        """
+        self.last_value = None
+        self.last_number = None
+
+    def within_deadband(self, number):
+        if self.last_number is None:
+            return False
+        delta = abs(number - self.last_number)
+        if delta <= self.deadband:
+            return True
+        return delta <= self.relative * abs(self.last_number)
+
+    def accept(self, value, now=None):
+        """
+        Return True if value should be notified, and record it as sent.
+
+        """
+        if now is None:
+            now = clock.get_scheduler().now()
+        value = bytes(bytearray(value))
+
+        suppress = False
+        number = None
+        if self.last_value is not None:
+            if value == self.last_value:
+                suppress = True
+            elif self.deadband or self.relative:
+                number = self.decode(value)
+                suppress = self.within_deadband(number)
+
+        if suppress:
+            if self.max_quiet is None or now - self.last_sent < self.max_quiet:
+                self.suppressed += 1
+                return False
+            self.heartbeats += 1
+
+        if number is None and (self.deadband or self.relative):
+            number = self.decode(value)
+        self.last_value = value
+        self.last_number = number
+        self.last_sent = now
+        self.sent += 1
+        return True
+
+    def stats(self):
+        return {'sent': self.sent, 'suppressed': self.suppressed,
+                'heartbeats': self.heartbeats}
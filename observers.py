@@ -0,0 +1,140 @@
+"""
+Hooks around the GATT handlers of Characteristic and Descriptor objects.
+
+The Characteristic and Descriptor base classes wrap the handlers overridden by
+their subclasses with observed(), so that every registered observer is called
+as observer(obj, name, args, elapsed, error) after the handler returned or
+raised. error is the raised exception, or None. Observers with a true
+wants_result attribute are called with the value the handler returned (None
+if it raised) as a sixth argument. Handler calls made within an unobserved()
+block, such as writes replayed from another process, are not reported.
+
+Characteristics also report the PropertiesChanged signals they emit, through
+observe_signal() or signal_emitted(), as
+observer(obj, 'PropertiesChanged', args, 0.0, None).
+"""
+from __future__ import print_function
+import contextlib
+import functools
+import time
+
+
+HANDLER_NAMES = ('ReadValue', 'WriteValue', 'StartNotify', 'StopNotify')
+
+_observers = []
+_unobserved = 0
+
+
+def add_observer(observer):
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def remove_observer(observer):
+    if observer in _observers:
+        _observers.remove(observer)
+
+
+@contextlib.contextmanager
+def unobserved():
+    """
+    Call the handlers within the block without notifying the observers.
+
+    """
+    global _unobserved
+    _unobserved += 1
+    try:
+        yield
+    finally:
+        _unobserved -= 1
+
+
+def observed(name, handler):
+    @functools.wraps(handler)
+    def wrapper(self, *args):
+        # Handlers chaining up to an overridden handler are observed once
+        if not _observers or _unobserved or self.__dict__.get('_observing'):
+            return handler(self, *args)
+
+        error = None
+        result = None
+        self._observing = True
+        start = time.monotonic()
+        try:
+            result = handler(self, *args)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            self._observing = False
+            for observer in list(_observers):
+                if getattr(observer, 'wants_result', False):
+                    observer(self, name, args, elapsed, error, result)
+                else:
+                    observer(self, name, args, elapsed, error)
+
+    wrapper._observed = True
+    return wrapper
+
+
+def observe_handlers(cls):
+    """
+    Wrap the handlers defined directly on cls. Called from __init_subclass__ of
+    the GATT base classes.
+
+    """
+    for name in HANDLER_NAMES:
+        handler = cls.__dict__.get(name)
+        if handler is None or getattr(handler, '_observed', False):
+            continue
+        if getattr(handler, '_dbus_is_method', False):
+            continue
+        setattr(cls, name, observed(name, handler))
+
+
+def observe_signal(obj, name):
+    """
+    Wrap the signal method name of obj so that observers see every emission.
+    Emissions from within a handler are reported as well.
+
+    """
+    signal = getattr(obj, name)
+
+    def emit(*args):
+        signal(*args)
+        signal_emitted(obj, name, args)
+
+    setattr(obj, name, emit)
+
+
+def signal_emitted(obj, name, args):
+    """
+    Report the emission of signal name by obj, for signals sent without
+    going through the method wrapped by observe_signal().
+
+    """
+    if not _observers:
+        return
+    for observer in list(_observers):
+        observer(obj, name, args, 0.0, None)
+
+
+def options_device(args):
+    """
+    Return the 'device' object path from the options dict of a handler call,
+    or None if the call carries no options or no device.
+
+    """
+    if not args:
+        return None
+
+    options = args[-1]
+    if not isinstance(options, dict):
+        return None
+
+    device = options.get('device')
+    if device is None:
+        return None
+    return str(device)
@@ -0,0 +1,96 @@
+"""
+Opt-in TTL cache of ReadValue results.
+
+A characteristic opts in by setting read_cache_ttl (seconds), on its class or
+instance. The value a ReadValue handler returns is then stored, per read
+offset, as bytes ready to be sent as the 'ay' reply, and served until it
+expires or a WriteValue on the same object succeeds. invalidate() drops it
+explicitly, e.g. when the source of the value changed.
+
+Handlers run one at a time on the main loop, so concurrent misses for the
+same value cannot happen: the first miss fills the cache before the next
+read is dispatched, which gives single-flight behaviour without locking.
+"""
+from __future__ import print_function
+import functools
+
+import clock
+
+
+def _state(obj):
+    state = obj.__dict__.get('_read_cache')
+    if state is None:
+        state = obj._read_cache = {'values': {}, 'hits': 0, 'misses': 0,
+                                   'busy': False}
+    return state
+
+
+def cached_read(handler):
+    @functools.wraps(handler)
+    def wrapper(self, options):
+        ttl = self.read_cache_ttl
+        if ttl is None:
+            return handler(self, options)
+
+        state = _state(self)
+        # Handlers chaining up to an overridden ReadValue are cached once
+        if state['busy']:
+            return handler(self, options)
+
+        offset = int(options.get('offset', 0))
+        now = clock.get_scheduler().now()
+        entry = state['values'].get(offset)
+        if entry is not None and entry[1] > now:
+            state['hits'] += 1
+            return entry[0]
+
+        state['misses'] += 1
+        state['busy'] = True
+        try:
+            value = bytes(bytearray(handler(self, options)))
+        finally:
+            state['busy'] = False
+        state['values'][offset] = (value, now + ttl)
+        return value
+
+    wrapper._cached = True
+    return wrapper
+
+
+def invalidating_write(handler):
+    @functools.wraps(handler)
+    def wrapper(self, value, options):
+        result = handler(self, value, options)
+        if self.read_cache_ttl is not None:
+            invalidate(self)
+        return result
+
+    wrapper._cached = True
+    return wrapper
+
+
+def invalidate(obj):
+    _state(obj)['values'].clear()
+
+
+def stats(obj):
+    state = _state(obj)
+    return {'hits': state['hits'], 'misses': state['misses'],
+            'entries': len(state['values'])}
+
+
+def cache_handlers(cls):
+    """
+    Wrap ReadValue and WriteValue defined directly on cls. Called from
+    __init_subclass__ of the GATT base classes, before the handlers are
+    wrapped for the observers, so that cache hits are still observed.
+
+    """
+    for name, wrap in (('ReadValue', cached_read),
+                       ('WriteValue', invalidating_write)):
+        handler = cls.__dict__.get(name)
+        if handler is None or getattr(handler, '_cached', False):
+            continue
+        if getattr(handler, '_dbus_is_method', False):
+            continue
+        setattr(cls, name, wrap(handler))
@@ -0,0 +1,112 @@
+from __future__ import print_function
+
+import adapters
+
+
+PROTOCOL_MODE_BOOT = 0x00
+PROTOCOL_MODE_REPORT = 0x01
+
+
+class Session(object):
+    """
+    State of one connected central, keyed by its Device1 object path.
+
+    mtu and link are refreshed from the options of every handler call.
+    Subscriptions are not tracked: BlueZ does not say which device
+    StartNotify/StopNotify come from.
+
+    """
+    def __init__(self, device):
+        self.device = device
+        self.mtu = None
+        self.link = None
+        self.protocol_mode = PROTOCOL_MODE_REPORT
+
+    def update(self, options):
+        mtu = options.get('mtu')
+        if mtu is not None:
+            self.mtu = int(mtu)
+        link = options.get('link')
+        if link is not None:
+            self.link = str(link)
+
+    def payload_size(self, default=20):
+        """
+        Largest value that fits in one notification on this connection.
+
+        """
+        if self.mtu is None:
+            return default
+        return self.mtu - 3
+
+
+class SessionTable(object):
+    """
+    Sessions of the connected centrals. Lookups by device path are a single
+    dict access; sessions are dropped when the AdapterRegistry reports the
+    device disconnected.
+
+    """
+    def __init__(self, registry=None):
+        self.sessions = {}
+        self.close_listeners = []
+        if registry is not None:
+            registry.add_connection_listener(self._connection_changed)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def get(self, options):
+        """
+        Return the session of the device that issued a handler call, or None
+        if options do not name a device.
+
+        """
+        device = options.get('device')
+        if device is None:
+            return None
+
+        session = self.sessions.get(device)
+        if session is None:
+            session = Session(str(device))
+            self.sessions[session.device] = session
+            print('New session for %s' % session.device)
+        session.update(options)
+        return session
+
+    def lookup(self, device):
+        return self.sessions.get(device)
+
+    def add_close_listener(self, listener):
+        """
+        Call listener(session) when a session is dropped.
+
+        """
+        self.close_listeners.append(listener)
+
+    def drop(self, device):
+        session = self.sessions.pop(device, None)
+        if session is None:
+            return
+
+        print('Session for %s closed' % device)
+        for listener in list(self.close_listeners):
+            listener(session)
+
+    def _connection_changed(self, device, adapter, connected):
+        if not connected:
+            self.drop(device)
+
+
+_tables = {}
+
+
+def get_session_table(bus):
+    table = _tables.get(bus)
+    if table is None:
+        table = SessionTable(adapters.get_registry(bus))
+        _tables[bus] = table
+    return table
@@ -0,0 +1,200 @@
+"""
+Vectorized synthetic sensors for load testing.
+
+A SensorBank generates the samples of many simulated sensors at once, a block
+of ticks at a time, with NumPy: heart rate as a noisy return to a per-sensor
+baseline, the RR interval and cumulated energy expended derived from it, and
+battery levels following a discharge curve. Each block is encoded in batch
+into Heart Rate Measurement and Battery Level values (bytes, ready for
+PropertiesChanged). A Simulation hands one tick of values per interval to
+the notification path of the characteristics, from a single timer.
+
+numpy is optional for the rest of the package and only needed here.
+"""
+from __future__ import print_function
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import clock
+
+
+# Heart Rate Measurement flags: sensor contact detected, energy expended and
+# RR interval present, 8-bit heart rate
+HR_FLAGS = 0x06 | 0x08 | 0x10
+
+HR_MEASUREMENT = [('flags', 'u1'), ('heart_rate', 'u1'),
+                  ('energy_expended', '<u2'), ('rr_interval', '<u2')]
+
+
+class SensorBank(object):
+    """
+    Samples of count simulated sensors, interval milliseconds apart, generated
+    block ticks at a time from a seeded generator.
+
+    """
+    def __init__(self, count, block=64, interval=1000, seed=0):
+        if numpy is None:
+            raise ImportError('simulation.SensorBank needs numpy')
+
+        self.count = count
+        self.block = block
+        self.dt = interval / 1000.0
+        self.rng = numpy.random.default_rng(seed)
+        self.baseline = self.rng.uniform(60, 100, count)
+        self.heart_rate = self.baseline.copy()
+        self.energy = numpy.zeros(count)
+        self.battery_life = self.rng.uniform(8, 24, count) * 3600
+        self.elapsed = 0.0
+
+    def heart_rate_block(self):
+        """
+        Return the Heart Rate Measurement values of the next block, as a
+        (block, count) structured array.
+
+        """
+        noise = self.rng.normal(0.0, 1.5, (self.block, self.count))
+        rates = numpy.empty((self.block, self.count))
+        current = self.heart_rate
+        for i in range(self.block):
+            current = self.baseline + 0.9 * (current - self.baseline) + noise[i]
+            rates[i] = current
+        self.heart_rate = current
+        numpy.clip(rates, 40, 200, out=rates)
+
+        # Roughly 0.1 kJ/s at rest, more with the heart rate
+        energy = numpy.cumsum(rates * (0.0015 * self.dt), axis=0) + self.energy
+        self.energy = energy[-1]
+
+        out = numpy.empty((self.block, self.count), dtype=HR_MEASUREMENT)
+        out['flags'] = HR_FLAGS
+        out['heart_rate'] = rates
+        out['energy_expended'] = numpy.minimum(energy, 0xffff)
+        # RR interval in 1/1024 s
+        out['rr_interval'] = numpy.rint(61440.0 / rates)
+        return out
+
+    def battery_block(self):
+        """
+        Return the battery levels (percent) of the next block, as a
+        (block, count) uint8 array.
+
+        """
+        t = self.elapsed + self.dt * numpy.arange(1, self.block + 1)
+        self.elapsed = t[-1]
+        remaining = numpy.clip(1.0 - t[:, None] / self.battery_life, 0, 1)
+        levels = 100.0 * remaining ** 0.7 + \
+                self.rng.normal(0.0, 0.4, (self.block, self.count))
+        return numpy.clip(numpy.rint(levels), 0, 100).astype(numpy.uint8)
+
+
+def encode_rows(block):
+    """
+    Split a (ticks, sensors) array of fixed size values into one list of
+    bytes objects per tick, without a Python loop per value.
+
+    """
+    values = numpy.ascontiguousarray(block)
+    raw = values.view(numpy.dtype((numpy.void, values.dtype.itemsize)))
+    return raw.tolist()
+
+
+class Simulation(object):
+    """
+    Feeds the values of a SensorBank to sinks, one call per sensor and tick:
+    typically the notify_value() methods of count characteristics.
+
+    """
+    def __init__(self, bank, scheduler=None):
+        if scheduler is None:
+            scheduler = clock.get_scheduler()
+        self.scheduler = scheduler
+        self.bank = bank
+        self.feeds = []
+        self.timer = None
+        self.ticks = 0
+        self.values = 0
+        self.generate_time = 0.0
+
+    def add_heart_rate(self, sinks):
+        self._add_feed(self.bank.heart_rate_block, sinks)
+
+    def add_battery(self, sinks):
+        self._add_feed(self.bank.battery_block, sinks)
+
+    def _add_feed(self, generate, sinks):
+        sinks = list(sinks)
+        if len(sinks) != self.bank.count:
+            raise ValueError('%d sinks for %d sensors' %
+                             (len(sinks), self.bank.count))
+        self.feeds.append([generate, sinks, [], 0])
+
+    def start(self):
+        if self.timer is None:
+            self.timer = self.scheduler.timeout_add(int(self.bank.dt * 1000),
+                                                    self.tick)
+
+    def stop(self):
+        if self.timer is not None:
+            self.scheduler.source_remove(self.timer)
+            self.timer = None
+
+    def tick(self):
+        for feed in self.feeds:
+            generate, sinks, rows, index = feed
+            if index == len(rows):
+                start = time.perf_counter()
+                rows = feed[2] = encode_rows(generate())
+                self.generate_time += time.perf_counter() - start
+                index = 0
+            for sink, value in zip(sinks, rows[index]):
+                sink(value)
+            feed[3] = index + 1
+            self.values += len(sinks)
+        self.ticks += 1
+        return True
+
+
+def benchmark(count=10000, seconds=10):
+    """
+    Simulate count heart rate sensors for seconds of virtual time against a
+    LocalBus and report the CPU time per simulated second.
+
+    """
+    import local_bus
+    import gatt_server
+
+    scheduler = clock.VirtualScheduler()
+    clock.set_scheduler(scheduler)
+    try:
+        bus = local_bus.LocalBus()
+        service = gatt_server.Service(bus, 0, '180d', True)
+        chrcs = []
+        for i in range(count):
+            chrc = gatt_server.Characteristic(bus, i, '2a37', ['notify'],
+                                              service)
+            chrc.notifying = True
+            chrcs.append(chrc)
+
+        simulation = Simulation(SensorBank(count), scheduler)
+        simulation.add_heart_rate(chrc.notify_value for chrc in chrcs)
+        simulation.start()
+
+        start = time.perf_counter()
+        scheduler.advance(seconds)
+        elapsed = time.perf_counter() - start
+    finally:
+        clock.set_scheduler(clock.RealScheduler())
+
+    print('%d sensors, %d values, %d signals: %.3f s per simulated second '
+          '(%.3f s generating)' %
+          (count, simulation.values, bus.signals_sent, elapsed / seconds,
+           simulation.generate_time / seconds))
+    return elapsed / seconds
+
+
+if __name__ == '__main__':
+    benchmark()
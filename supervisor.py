@@ -0,0 +1,257 @@
+from __future__ import print_function
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
+
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+
+try:
+  from gi.repository import GObject
+except ImportError:
+  import gobject as GObject
+
+import adapters
+import observers
+import value_table
+
+
+def is_writable(flags):
+    for flag in flags:
+        if 'write' in flag and flag != 'writable-auxiliaries':
+            return True
+    return False
+
+
+class Worker(object):
+    """
+    Worker side of the process-per-adapter mode. Writes handled by this process
+    are stored in the shared ValueTable and announced to the supervisor, and
+    writes announced by the other workers are replayed on the local
+    characteristics, so that every worker serves the same state.
+
+    Session scoped characteristics (e.g. HID Protocol Mode) hold the state of
+    one connection, which lives in one worker, and are not shared.
+
+    """
+    def __init__(self, conn, table, mainloop):
+        self.conn = conn
+        self.table = table
+        self.mainloop = mainloop
+        self.objects = {}
+        self.command_handlers = {'quit': mainloop.quit}
+
+    def attach(self, app):
+        for service in app.services:
+            for chrc in service.get_characteristics():
+                if not is_writable(chrc.flags) or chrc.session_scoped:
+                    continue
+
+                index = self.table.bind(str(chrc.get_path()))
+                self.objects[index] = chrc
+                value, version = self.table.read(index)
+                if version:
+                    self._replay(chrc, value)
+
+        observers.add_observer(self._handler_called)
+        GObject.io_add_watch(self.conn.fileno(), GObject.IO_IN,
+                             self._message_cb)
+
+    def on_command(self, name, handler):
+        self.command_handlers[name] = handler
+
+    def send_command(self, name, *args):
+        """
+        Run the command on every other worker.
+
+        """
+        self.conn.send(('command', name, args))
+
+    def _handler_called(self, obj, name, args, elapsed, error):
+        if name != 'WriteValue' or error is not None:
+            return
+
+        index = self.table.indexes.get(str(obj.get_path()))
+        if index is None or self.objects.get(index) is not obj:
+            return
+
+        self.table.write(index, bytes(bytearray(args[0])))
+        self.conn.send(('write', index))
+
+    def _replay(self, chrc, value):
+        # Not a client write: neither shared again nor counted, logged or
+        # timed by the observers
+        try:
+            with observers.unobserved():
+                chrc.WriteValue([dbus.Byte(b) for b in bytearray(value)], {})
+        except dbus.exceptions.DBusException as e:
+            print('Replayed write on %s failed: %s' % (chrc.get_path(), e))
+
+    def _message_cb(self, fd, condition):
+        while self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                print('Supervisor went away, quitting')
+                self.mainloop.quit()
+                return False
+
+            if message[0] == 'write':
+                chrc = self.objects.get(message[1])
+                if chrc is not None:
+                    self._replay(chrc, self.table.read(message[1])[0])
+            elif message[0] == 'command':
+                handler = self.command_handlers.get(message[1])
+                if handler is None:
+                    print('Unknown command: %s' % message[1])
+                    continue
+                handler(*message[2])
+
+        return True
+
+
+def worker_main(conn, table, adapter_name, gatt_module, advertising_module,
+                setup=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+    mainloop = GObject.MainLoop()
+    if setup is not None:
+        setup(adapter_name)
+
+    worker = Worker(conn, table, mainloop)
+    advertising_module.advertising_main(mainloop, bus, adapter_name)
+    app = gatt_module.gatt_server_main(mainloop, bus, adapter_name)
+    worker.attach(app)
+
+    print('Worker for %s running' % adapter_name)
+    mainloop.run()
+
+
+def list_adapter_names(adapter_interface_name):
+    bus = dbus.SystemBus(private=True)
+    try:
+        registry = adapters.AdapterRegistry(bus)
+        return [path.rsplit('/', 1)[-1]
+                for path in registry.find_all(adapter_interface_name)]
+    finally:
+        bus.close()
+
+
+class Supervisor(object):
+    """
+    Forks one worker process per adapter, each running its own GLib main loop,
+    advertisement and Application, and relays write and command messages
+    between them. Workers that die are restarted, unless they die within
+    MIN_UPTIME seconds of being started.
+
+    setup(adapter_name), if given, is called in every worker before its
+    Application is created, e.g. to apply command line options.
+
+    """
+    MIN_UPTIME = 5.0
+
+    def __init__(self, adapter_names, gatt_module, advertising_module,
+                 table=None, setup=None):
+        self.adapter_names = list(adapter_names)
+        self.gatt_module = gatt_module
+        self.advertising_module = advertising_module
+        self.setup = setup
+        self.table = table if table is not None else value_table.ValueTable()
+        self.context = multiprocessing.get_context('fork')
+        self.workers = {}
+        self.running = False
+
+    def _spawn(self, adapter_name):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+                target=worker_main,
+                args=(child_conn, self.table, adapter_name,
+                      self.gatt_module, self.advertising_module, self.setup),
+                name='gatt-' + adapter_name)
+        process.start()
+        child_conn.close()
+        self.workers[adapter_name] = (process, parent_conn, time.monotonic())
+        print('Started worker %d for %s' % (process.pid, adapter_name))
+
+    def start(self):
+        self.running = True
+        for adapter_name in self.adapter_names:
+            self._spawn(adapter_name)
+
+    def broadcast(self, message, exclude=None):
+        for adapter_name, (process, conn, started) in self.workers.items():
+            if adapter_name == exclude:
+                continue
+            try:
+                conn.send(message)
+            except (BrokenPipeError, OSError):
+                pass
+
+    def stop(self):
+        self.running = False
+        self.broadcast(('command', 'quit', ()))
+        for process, conn, started in self.workers.values():
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+
+    def run_once(self, timeout=1.0):
+        by_conn = {}
+        by_sentinel = {}
+        for adapter_name, (process, conn, started) in self.workers.items():
+            by_conn[conn] = adapter_name
+            by_sentinel[process.sentinel] = adapter_name
+
+        ready = multiprocessing.connection.wait(
+                list(by_conn) + list(by_sentinel), timeout)
+        for item in ready:
+            if item in by_conn:
+                adapter_name = by_conn[item]
+                try:
+                    message = item.recv()
+                except EOFError:
+                    continue
+                self.broadcast(message, exclude=adapter_name)
+            elif item in by_sentinel and self.running:
+                adapter_name = by_sentinel[item]
+                process, conn, started = self.workers.pop(adapter_name)
+                conn.close()
+                print('Worker for %s exited with %s' %
+                      (adapter_name, process.exitcode))
+                if time.monotonic() - started >= self.MIN_UPTIME:
+                    self._spawn(adapter_name)
+
+        if not self.workers:
+            self.running = False
+
+    def run(self):
+        self.start()
+        try:
+            while self.running:
+                self.run_once()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def supervisor_main(gatt_module, advertising_module, adapter_names,
+                    setup=None):
+    """
+    Serve gatt_module's Application with one process per adapter. An empty
+    adapter_names list selects every adapter with GattManager1. setup is
+    called in every worker (see Supervisor).
+
+    """
+    if not adapter_names:
+        adapter_names = list_adapter_names(gatt_module.GATT_MANAGER_IFACE)
+    if not adapter_names:
+        raise Exception('GattManager1 interface not found')
+
+    Supervisor(adapter_names, gatt_module, advertising_module,
+               setup=setup).run()
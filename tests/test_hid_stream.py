@@ -0,0 +1,50 @@
+"""
+Pacing of the keyboard report pipeline, in virtual time.
+"""
+from __future__ import print_function
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clock
+import hid_stream
+
+
+class ReportSink(object):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.sent = []
+
+    def is_streaming(self):
+        return True
+
+    def send_report(self, report):
+        self.sent.append(self.scheduler.now())
+
+
+class KeyReportPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = clock.VirtualScheduler()
+        self.sink = ReportSink(self.scheduler)
+        self.pipeline = hid_stream.KeyReportPipeline(
+                self.sink, scheduler=self.scheduler)
+
+    def test_push_after_drain_keeps_pacing(self):
+        self.pipeline.push('a')
+        self.pipeline.drain()
+        self.assertEqual(len(self.sink.sent), 2)
+
+        # One report per 15 ms interval, not two timers sending
+        self.pipeline.push('b')
+        self.pipeline.push('c')
+        self.scheduler.advance(0.1)
+        sent = self.sink.sent[2:]
+        self.assertEqual(len(sent), 4)
+        for previous, current in zip(sent, sent[1:]):
+            self.assertAlmostEqual(current - previous, 0.015)
+
+
+if __name__ == '__main__':
+    unittest.main()
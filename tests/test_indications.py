@@ -0,0 +1,60 @@
+"""
+Pacing of indications on Confirm, in virtual time.
+"""
+from __future__ import print_function
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clock
+import indications
+
+
+class IndicationQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = clock.VirtualScheduler()
+        self.centrals = ['/org/bluez/hci0/dev_1', '/org/bluez/hci0/dev_2']
+        self.sent = []
+        self.queue = indications.IndicationQueue(
+                self.sent.append, scheduler=self.scheduler,
+                subscribers=lambda: self.centrals)
+
+    def test_idle_central_costs_one_timeout(self):
+        # Only one of the two connected centrals subscribed and confirms
+        for value in range(10):
+            self.queue.push(value)
+        confirmed = 0
+        while self.queue.outstanding:
+            if confirmed < len(self.sent):
+                confirmed += 1
+                self.queue.confirm()
+            self.scheduler.advance(0.01)
+
+        self.assertEqual(self.sent, list(range(10)))
+        self.assertEqual(self.queue.timeouts, 1)
+        self.assertEqual(self.queue.unconfirmed, 1)
+        self.assertLess(self.scheduler.now(), 1.2)
+
+    def test_both_centrals_confirm(self):
+        self.queue.push(1)
+        self.queue.push(2)
+        self.queue.confirm()
+        self.assertEqual(self.sent, [1])
+        self.queue.confirm()
+        self.assertEqual(self.sent, [1, 2])
+
+    def test_full_queue_keeps_outstanding_value(self):
+        queue = indications.IndicationQueue(self.sent.append, size=2,
+                                            scheduler=self.scheduler)
+        for value in range(4):
+            queue.push(value)
+        self.assertEqual(list(queue.queue), [0, 3])
+        self.assertEqual(queue.dropped, 2)
+        self.assertRaises(ValueError, indications.IndicationQueue,
+                          self.sent.append, size=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+HID Protocol Mode switches while reports are streaming, on a LocalBus in
+virtual time.
+"""
+from __future__ import print_function
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbus
+
+import adapters
+import clock
+import gatt_server_hid
+import keyboard_layouts
+import local_bus
+import sessions
+
+
+DEVICE = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+
+
+class ProtocolModeSwitchTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = clock.VirtualScheduler()
+        clock.set_scheduler(self.scheduler)
+        self.bus = local_bus.LocalBus()
+        self.service = gatt_server_hid.HidService(self.bus, 0)
+        self.bus.emit_remote_signal(
+                DEVICE, gatt_server_hid.DBUS_PROP_IFACE, 'PropertiesChanged',
+                adapters.DEVICE_IFACE, {'Connected': True}, [])
+
+        self.mode = sessions.PROTOCOL_MODE_REPORT
+        self.signals = []
+        self.bus.add_signal_listener(self.signal_sent)
+
+    def tearDown(self):
+        clock.set_scheduler(clock.RealScheduler())
+
+    def signal_sent(self, path, interface, member, args):
+        if member != 'PropertiesChanged' or 'Value' not in args[1]:
+            return
+        self.signals.append((self.mode, str(path),
+                             bytes(bytearray(args[1]['Value']))))
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.service.protocol_mode_characteristic.WriteValue(
+                [dbus.Byte(mode)], {'device': dbus.ObjectPath(DEVICE)})
+
+    def switch_while_streaming(self):
+        # Report, boot, then report mode again, with reports still queued
+        self.scheduler.advance(0.3)
+        self.set_mode(sessions.PROTOCOL_MODE_BOOT)
+        self.scheduler.advance(0.3)
+        self.set_mode(sessions.PROTOCOL_MODE_REPORT)
+
+    def check_paths(self, report_chrc, boot_chrc):
+        modes = set()
+        for mode, path, value in self.signals:
+            modes.add(mode)
+            if mode == sessions.PROTOCOL_MODE_BOOT:
+                self.assertEqual(path, boot_chrc.path)
+            else:
+                self.assertEqual(path, report_chrc.path)
+        self.assertEqual(modes, set([sessions.PROTOCOL_MODE_BOOT,
+                                     sessions.PROTOCOL_MODE_REPORT]))
+        self.assertEqual(self.signals[-1][0], sessions.PROTOCOL_MODE_REPORT)
+
+    def test_keyboard_reports_follow_protocol_mode(self):
+        report_chrc = self.service.report_characteristic
+        boot_chrc = self.service.boot_keyboard_input
+        report_chrc.StartNotify()
+        boot_chrc.StartNotify()
+
+        # 84 reports at one per 15 ms: done before the demo letter at 5 s
+        text = 'switching modes ' * 2 + 'mid-stream'
+        self.service.type_text(text)
+        self.switch_while_streaming()
+        self.scheduler.advance(1.5)
+
+        self.check_paths(report_chrc, boot_chrc)
+        expected = keyboard_layouts.get_layout('us').encode(text)
+        sent = b''.join(value for mode, path, value in self.signals)
+        self.assertEqual(sent, expected)
+
+    def test_mouse_reports_follow_protocol_mode(self):
+        report_chrc = self.service.mouse_characteristic
+        boot_chrc = self.service.boot_mouse_input
+        report_chrc.StartNotify()
+        boot_chrc.StartNotify()
+
+        # 800 moves at 1 kHz
+        for i in range(800):
+            self.scheduler.timeout_add(i + 1, report_chrc.move, 1, -1)
+        self.switch_while_streaming()
+        self.scheduler.advance(1.0)
+
+        self.check_paths(report_chrc, boot_chrc)
+        dx = dy = 0
+        for mode, path, value in self.signals:
+            if mode == sessions.PROTOCOL_MODE_BOOT:
+                self.assertEqual(len(value), 3)
+            dx += value[1] - 256 if value[1] > 127 else value[1]
+            dy += value[2] - 256 if value[2] > 127 else value[2]
+        self.assertEqual((dx, dy), (800, -800))
+
+
+if __name__ == '__main__':
+    unittest.main()
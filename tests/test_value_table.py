@@ -0,0 +1,49 @@
+"""
+Seqlock of the memory-mapped ValueStore.
+"""
+from __future__ import print_function
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import value_table
+
+
+class ValueStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = value_table.ValueStore(
+                os.path.join(self.directory, 'values'))
+        self.index = self.store.bind('/org/bluez/example/service0/char0')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_read(self):
+        self.assertEqual(self.store.read(self.index), (b'', 0))
+        self.store.write(self.index, b'\x42')
+        self.store.write(self.index, b'\x43\x44')
+        self.assertEqual(self.store.read(self.index), (b'\x43\x44', 4))
+
+    def test_write_recovers_from_interrupted_write(self):
+        self.store.write(self.index, b'\x42')
+
+        # A writer that died between the two sequence updates
+        struct.pack_into('<I', self.store.buf,
+                         self.store._offset(self.index) +
+                         self.store.SEQ_OFFSET, 3)
+        self.assertRaises(value_table.SlotBusy, self.store.read, self.index)
+
+        self.store.write(self.index, b'\x43')
+        self.assertEqual(self.store.read(self.index), (b'\x43', 6))
+        self.store.write(self.index, b'\x44')
+        self.assertEqual(self.store.read(self.index), (b'\x44', 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
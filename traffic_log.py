@@ -0,0 +1,342 @@
+"""
+Binary log of the GATT traffic handled by an Application, and its replay.
+
+A Recorder is an observer: every ReadValue, WriteValue, StartNotify,
+StopNotify and Value PropertiesChanged becomes one record appended to the log
+through a buffered file. The log starts with LOG_HEADER; each record is
+
+    u32 length of the rest of the record
+    f64 wall clock time, u8 kind, u8 1 if the handler raised
+    u16 + path, u16 + device, u16 + options, u32 + payload
+
+with strings in UTF-8, options as u8 count followed by u8 + key, u8 type
+('i' signed 64-bit, 's' u16 + UTF-8) and the value, all little-endian. The
+payload is the value written, read (empty if the read failed) or notified.
+Logs of layout version 1 did not record the values read.
+
+replay() drives the recorded handler calls against a fresh Application on a
+LocalBus, paced like the recording or as fast as possible, and compares the
+values read and the notifications emitted with the recorded ones.
+"""
+from __future__ import print_function
+import argparse
+import collections
+import struct
+import time
+
+import clock
+import observers
+
+
+LOG_HEADER = b'GATL\x02\x00'
+# Values read are not recorded in this layout
+LOG_HEADER_V1 = b'GATL\x01\x00'
+
+READ = 1
+WRITE = 2
+START_NOTIFY = 3
+STOP_NOTIFY = 4
+PROPERTIES_CHANGED = 5
+
+KINDS = {
+    'ReadValue': READ,
+    'WriteValue': WRITE,
+    'StartNotify': START_NOTIFY,
+    'StopNotify': STOP_NOTIFY,
+    'PropertiesChanged': PROPERTIES_CHANGED,
+}
+
+LENGTH = struct.Struct('<I')
+RECORD_HEAD = struct.Struct('<dBB')
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+I64 = struct.Struct('<q')
+
+Record = collections.namedtuple(
+        'Record', 'time kind error path device options payload')
+
+
+class LogError(Exception):
+    pass
+
+
+def _string(value):
+    data = value.encode('utf-8')
+    return U16.pack(len(data)) + data
+
+
+def _string_bytes(data):
+    return U16.pack(len(data)) + data
+
+
+def encode_options(options):
+    parts = []
+    for key, value in options.items():
+        if key == 'device':
+            continue
+        key = str(key).encode('utf-8')
+        if isinstance(value, int):
+            encoded = b'i' + I64.pack(int(value))
+        else:
+            encoded = b's' + _string(str(value))
+        parts.append(U8.pack(len(key)) + key + encoded)
+    return U8.pack(len(parts)) + b''.join(parts)
+
+
+def decode_options(data):
+    options = {}
+    count = data[0]
+    i = 1
+    for n in range(count):
+        length = data[i]
+        key = data[i + 1:i + 1 + length].decode('utf-8')
+        i += 1 + length
+        kind = data[i:i + 1]
+        i += 1
+        if kind == b'i':
+            options[key] = I64.unpack_from(data, i)[0]
+            i += I64.size
+        else:
+            length = U16.unpack_from(data, i)[0]
+            options[key] = data[i + 2:i + 2 + length].decode('utf-8')
+            i += 2 + length
+    return options
+
+
+def encode_record(timestamp, kind, error, path, device, options, payload):
+    body = b''.join([
+        RECORD_HEAD.pack(timestamp, kind, error),
+        _string(path), _string(device or ''),
+        _string_bytes(encode_options(options)),
+        LENGTH.pack(len(payload)), payload,
+    ])
+    return LENGTH.pack(len(body)) + body
+
+
+def decode_record(body):
+    timestamp, kind, error = RECORD_HEAD.unpack_from(body, 0)
+    i = RECORD_HEAD.size
+    fields = []
+    for n in range(3):
+        length = U16.unpack_from(body, i)[0]
+        fields.append(body[i + 2:i + 2 + length])
+        i += 2 + length
+    length = LENGTH.unpack_from(body, i)[0]
+    payload = body[i + 4:i + 4 + length]
+    if len(payload) != length:
+        raise LogError('truncated record')
+    return Record(timestamp, kind, bool(error), fields[0].decode('utf-8'),
+                  fields[1].decode('utf-8') or None,
+                  decode_options(fields[2]), payload)
+
+
+def read_records(path):
+    """
+    Yield the Records of a log. A record cut short at the end of the file
+    (e.g. by a crash while writing) ends the log. The payload of reads is
+    None in logs that did not record it.
+
+    """
+    with open(path, 'rb') as f:
+        header = f.read(len(LOG_HEADER))
+        if header not in (LOG_HEADER, LOG_HEADER_V1):
+            raise LogError('%s is not a GATT traffic log' % path)
+        while True:
+            head = f.read(LENGTH.size)
+            if len(head) < LENGTH.size:
+                return
+            body = f.read(LENGTH.unpack(head)[0])
+            try:
+                record = decode_record(body)
+            except (LogError, struct.error):
+                return
+            if header == LOG_HEADER_V1 and record.kind == READ:
+                record = record._replace(payload=None)
+            yield record
+
+
+class Recorder(object):
+    """
+    Observer appending the handled traffic to the log at path. Writes are
+    buffered and flushed every flush_interval milliseconds.
+
+    """
+    wants_result = True
+
+    def __init__(self, path, buffer_size=65536, flush_interval=1000):
+        self.file = open(path, 'ab', buffering=buffer_size)
+        if self.file.tell() == 0:
+            self.file.write(LOG_HEADER)
+        else:
+            with open(path, 'rb') as f:
+                header = f.read(len(LOG_HEADER))
+            if header != LOG_HEADER:
+                self.file.close()
+                raise LogError('%s is not a GATT traffic log of this version'
+                               % path)
+        self.records = 0
+        observers.add_observer(self)
+        self.timer = clock.get_scheduler().timeout_add(flush_interval,
+                                                       self.flush)
+
+    def __call__(self, obj, name, args, elapsed, error, result=None):
+        kind = KINDS.get(name)
+        if kind is None:
+            return
+
+        options = {}
+        payload = b''
+        if kind == PROPERTIES_CHANGED:
+            value = args[1].get('Value')
+            if value is None:
+                return
+            payload = bytes(bytearray(value))
+        elif kind in (READ, WRITE):
+            options = args[-1]
+            if kind == WRITE:
+                payload = bytes(bytearray(args[0]))
+            elif result is not None:
+                payload = bytes(bytearray(result))
+
+        self.file.write(encode_record(
+                time.time(), kind, error is not None, obj.path,
+                observers.options_device(args), options, payload))
+        self.records += 1
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+        return self.file is not None
+
+    def close(self):
+        observers.remove_observer(self)
+        self.file.close()
+        self.file = None
+
+
+_recorder = None
+
+
+def start_recording(path):
+    """
+    Record the traffic of the objects of this process to the log at path.
+
+    """
+    global _recorder
+    _recorder = Recorder(path)
+    return _recorder
+
+
+def replay(path, module_name='gatt_server', speed=None):
+    """
+    Replay the handler calls of a log against a new Application of
+    module_name on a LocalBus, in virtual time. With speed set, calls are
+    also paced in real time (1.0 as recorded); otherwise they run as fast as
+    possible. Returns a dict of counters.
+
+    """
+    import importlib
+    import dbus
+    import dbus.exceptions
+    import adapters
+    import local_bus
+
+    module = importlib.import_module(module_name)
+    scheduler = clock.VirtualScheduler()
+    clock.set_scheduler(scheduler)
+    try:
+        bus = local_bus.LocalBus()
+        app = module.Application(bus)
+        objects = {}
+        for service in app.services:
+            for obj in service.get_objects():
+                objects[obj.path] = obj
+
+        result = dict(calls=0, errors=0, mismatches=0, missing=0,
+                      read_mismatches=0, recorded_notifications=0)
+        devices = set()
+        previous = None
+        start = time.perf_counter()
+        for record in read_records(path):
+            if previous is not None and record.time > previous:
+                gap = record.time - previous
+                scheduler.advance(gap)
+                if speed:
+                    time.sleep(gap / speed)
+            previous = record.time
+
+            if record.kind == PROPERTIES_CHANGED:
+                result['recorded_notifications'] += 1
+                continue
+
+            obj = objects.get(record.path)
+            if obj is None:
+                result['missing'] += 1
+                continue
+
+            options = dict(record.options)
+            if record.device is not None:
+                options['device'] = dbus.ObjectPath(record.device)
+                if record.device not in devices:
+                    devices.add(record.device)
+                    bus.emit_remote_signal(
+                            record.device, module.DBUS_PROP_IFACE,
+                            'PropertiesChanged', adapters.DEVICE_IFACE,
+                            {'Connected': True}, [])
+
+            error = False
+            try:
+                if record.kind == READ:
+                    value = bytes(bytearray(obj.ReadValue(options)))
+                    if record.payload is not None and \
+                            value != record.payload:
+                        result['read_mismatches'] += 1
+                elif record.kind == WRITE:
+                    value = dbus.Array([dbus.Byte(b) for b in record.payload],
+                                       signature='y')
+                    obj.WriteValue(value, options)
+                elif record.kind == START_NOTIFY:
+                    obj.StartNotify()
+                elif record.kind == STOP_NOTIFY:
+                    obj.StopNotify()
+            except dbus.exceptions.DBusException:
+                error = True
+                result['errors'] += 1
+            result['calls'] += 1
+            if error != record.error:
+                result['mismatches'] += 1
+
+        result['elapsed'] = time.perf_counter() - start
+        result['notifications'] = bus.signals_sent
+    finally:
+        clock.set_scheduler(clock.RealScheduler())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a GATT traffic log')
+    parser.add_argument('log', help='Log written with --record')
+    parser.add_argument('-m', '--module', default='gatt_server',
+                        help='Module of the Application to replay against')
+    parser.add_argument('-s', '--speed', type=float, default=None,
+                        help='Pace calls in real time (1 = as recorded); as '
+                             'fast as possible if omitted')
+    parser.add_argument('-d', '--dump', action='store_true',
+                        help='Print the records instead of replaying them')
+    args = parser.parse_args()
+
+    if args.dump:
+        for record in read_records(args.log):
+            print(record)
+        return
+
+    result = replay(args.log, args.module, args.speed)
+    print('%(calls)d calls (%(errors)d failed, %(mismatches)d differing from '
+          'the recording, %(read_mismatches)d reads returning other values, '
+          '%(missing)d to unknown objects) in %(elapsed).3f s; '
+          '%(notifications)d signals, %(recorded_notifications)d notifications '
+          'recorded' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+from __future__ import print_function
+import fcntl
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+
+try:
+  from gi.repository import GObject
+except ImportError:
+  import gobject as GObject
+
+
+class SlotBusy(Exception):
+    """
+    A value store slot stayed in a write for longer than
+    ValueStore.READ_TIMEOUT, e.g. because its writer crashed mid-write.
+
+    """
+    pass
+
+
+class ValueTable(object):
+    """
+    Table of characteristic values in a shared anonymous mapping. The table
+    must be created before the worker processes are forked so that all of them
+    see the same memory.
+
+    Every slot holds the key it is bound to (an object path), a version
+    counter bumped on each write and the last written value.
+
+    """
+    KEY_SIZE = 128
+    SLOT_HEADER = struct.Struct('<%dsIH' % KEY_SIZE)
+
+    def __init__(self, slots=128, value_size=512):
+        self.slots = slots
+        self.value_size = value_size
+        self.slot_size = self.SLOT_HEADER.size + value_size
+        self.buf = mmap.mmap(-1, slots * self.slot_size)
+        self.lock = multiprocessing.Lock()
+        self.indexes = {}
+
+    def _header(self, index):
+        return self.SLOT_HEADER.unpack_from(self.buf, index * self.slot_size)
+
+    def bind(self, key):
+        """
+        Return the slot index for key, claiming a free slot if no process
+        bound it yet.
+
+        """
+        index = self.indexes.get(key)
+        if index is not None:
+            return index
+
+        raw_key = key.encode('utf-8')
+        if len(raw_key) > self.KEY_SIZE:
+            raise ValueError('key too long: %s' % key)
+
+        with self.lock:
+            for index in range(self.slots):
+                slot_key = self._header(index)[0].rstrip(b'\0')
+                if slot_key == raw_key:
+                    break
+                if not slot_key:
+                    self.SLOT_HEADER.pack_into(self.buf,
+                                               index * self.slot_size,
+                                               raw_key, 0, 0)
+                    break
+            else:
+                raise Exception('value table full')
+
+        self.indexes[key] = index
+        return index
+
+    def write(self, index, data):
+        if len(data) > self.value_size:
+            raise ValueError('value too long: %d bytes' % len(data))
+
+        offset = index * self.slot_size
+        with self.lock:
+            key, version, length = self._header(index)
+            version = (version + 1) & 0xffffffff
+            start = offset + self.SLOT_HEADER.size
+            self.buf[start:start + len(data)] = bytes(data)
+            self.SLOT_HEADER.pack_into(self.buf, offset, key, version,
+                                       len(data))
+        return version
+
+    def read(self, index):
+        """
+        Return a (value, version) tuple. A version of 0 means the slot was
+        never written.
+
+        """
+        offset = index * self.slot_size
+        with self.lock:
+            key, version, length = self._header(index)
+            start = offset + self.SLOT_HEADER.size
+            return self.buf[start:start + length], version
+
+    def version(self, index):
+        return self._header(index)[1]
+
+
+class ValueStore(object):
+    """
+    Characteristic values in a memory-mapped file, so that producers running
+    in other processes can publish values without any IPC with the GATT
+    server.
+
+    Layout (little endian):
+        header: magic 'GATV', u16 layout version, u16 slot count,
+                u32 value size
+        slots:  char key[64], u32 sequence, u16 length, u16 reserved,
+                u8 value[value size]
+
+    Writers use a seqlock: the sequence is made odd before the value is
+    updated and even again afterwards. Readers retry while the sequence is odd
+    or changed during the copy. There must be a single writer per slot.
+
+    """
+    MAGIC = b'GATV'
+    LAYOUT_VERSION = 1
+    HEADER = struct.Struct('<4sHHI')
+    KEY_SIZE = 64
+    SLOT_HEADER = struct.Struct('<%dsIH2x' % KEY_SIZE)
+    SEQ_OFFSET = KEY_SIZE
+    # Seconds a reader waits for a write in progress
+    READ_TIMEOUT = 0.005
+
+    def __init__(self, path, slots=64, value_size=512):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size == 0:
+                size = self.HEADER.size + slots * (self.SLOT_HEADER.size +
+                                                   value_size)
+                os.ftruncate(fd, size)
+                self.buf = mmap.mmap(fd, size)
+                self.HEADER.pack_into(self.buf, 0, self.MAGIC,
+                                      self.LAYOUT_VERSION, slots, value_size)
+            else:
+                self.buf = mmap.mmap(fd, os.fstat(fd).st_size)
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+        magic, layout, self.slots, self.value_size = \
+                self.HEADER.unpack_from(self.buf, 0)
+        if magic != self.MAGIC or layout != self.LAYOUT_VERSION:
+            raise ValueError('%s is not a value store' % path)
+
+        self.slot_size = self.SLOT_HEADER.size + self.value_size
+        self.indexes = {}
+        self.watches = {}
+
+    def _offset(self, index):
+        return self.HEADER.size + index * self.slot_size
+
+    def bind(self, key):
+        """
+        Return the slot index for key, claiming a free slot if needed.
+
+        """
+        index = self.indexes.get(key)
+        if index is not None:
+            return index
+
+        raw_key = key.encode('utf-8')
+        if len(raw_key) > self.KEY_SIZE:
+            raise ValueError('key too long: %s' % key)
+
+        with open(self.path, 'r+b') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            for index in range(self.slots):
+                offset = self._offset(index)
+                slot_key = self.SLOT_HEADER.unpack_from(
+                        self.buf, offset)[0].rstrip(b'\0')
+                if slot_key == raw_key:
+                    break
+                if not slot_key:
+                    self.SLOT_HEADER.pack_into(self.buf, offset, raw_key, 0, 0)
+                    break
+            else:
+                raise Exception('value store full')
+
+        self.indexes[key] = index
+        return index
+
+    def sequence(self, index):
+        return struct.unpack_from('<I', self.buf,
+                                  self._offset(index) + self.SEQ_OFFSET)[0]
+
+    def write(self, index, data):
+        if len(data) > self.value_size:
+            raise ValueError('value too long: %d bytes' % len(data))
+
+        offset = self._offset(index)
+        # A writer that died mid-write left the sequence odd; start from the
+        # next even one so that the slot becomes readable again
+        seq = (self.sequence(index) + 1) & 0xfffffffe
+        struct.pack_into('<I', self.buf, offset + self.SEQ_OFFSET,
+                         (seq + 1) & 0xffffffff)
+        start = offset + self.SLOT_HEADER.size
+        self.buf[start:start + len(data)] = bytes(data)
+        struct.pack_into('<H', self.buf, offset + self.SEQ_OFFSET + 4,
+                         len(data))
+        struct.pack_into('<I', self.buf, offset + self.SEQ_OFFSET,
+                         (seq + 2) & 0xffffffff)
+
+    def read(self, index):
+        """
+        Return a consistent (value, sequence) tuple. A sequence of 0 means the
+        slot was never written. Raises SlotBusy if the slot is still being
+        written after READ_TIMEOUT.
+
+        """
+        offset = self._offset(index)
+        start = offset + self.SLOT_HEADER.size
+        deadline = None
+        while True:
+            seq = self.sequence(index)
+            if not seq & 1:
+                length = struct.unpack_from('<H', self.buf,
+                                            offset + self.SEQ_OFFSET + 4)[0]
+                value = self.buf[start:start + length]
+                if self.sequence(index) == seq:
+                    return value, seq
+
+            # Let the writer run instead of spinning against it
+            if deadline is None:
+                deadline = time.monotonic() + self.READ_TIMEOUT
+            elif time.monotonic() > deadline:
+                raise SlotBusy('value store slot %d stuck in a write' % index)
+            time.sleep(0)
+
+    def watch(self, index, callback):
+        """
+        Call callback(value) from poll() whenever the slot changes.
+
+        """
+        self.watches.setdefault(index, [self.sequence(index), []])[1].append(
+                callback)
+
+    def poll(self):
+        for index, watch in self.watches.items():
+            seq = self.sequence(index)
+            if seq == watch[0] or seq & 1:
+                continue
+
+            try:
+                value, watch[0] = self.read(index)
+            except SlotBusy:
+                continue
+            for callback in watch[1]:
+                callback(value)
+        return True
+
+    def start_polling(self, interval=100):
+        GObject.timeout_add(interval, self.poll)
+
+
+_store = None
+
+
+def open_store(path, interval=100):
+    """
+    Open the value store the characteristics of this process serve from and
+    start polling it for changes every interval milliseconds.
+
+    """
+    global _store
+    _store = ValueStore(path)
+    _store.start_polling(interval)
+    return _store
+
+
+def get_store():
+    return _store